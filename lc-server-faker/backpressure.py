@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import collections
+import tornado.locks
+from eventindex import connection_id
+from serialization import PushMessage
+from constants import *
+
+# What happens when a subscriber falls behind by more than its buffer: drop the oldest events, keep only the
+# latest event of every connection (and drop the oldest if that is not enough), or disconnect with a cursor
+POLICIES = ["drop", "coalesce", "disconnect"]
+# Totals over all subscribers
+STATS = {"dropped": 0, "coalesced": 0, "disconnected": 0}
+
+
+class SubscriberBuffer(object):
+    def __init__(self, capacity=SUBSCRIBER_BUFFER, policy=SUBSCRIBER_POLICY):
+        # Pages waiting to be written to a single subscriber, bounded by their number of events
+        self.capacity = capacity
+        self.policy = policy
+        self.messages = collections.deque()
+        self.events = 0
+        self.closed = False
+        self.available = tornado.locks.Event()
+
+    def put(self, message):
+        # False when the subscriber is too slow and has to be disconnected
+        if self.closed:
+            return True
+        self.messages.append(message)
+        self.events += len(message.page.get("@graph", ()))
+        self.available.set()
+        if len(self.messages) == 1 or (self.policy != "coalesce" and self.events <= self.capacity):
+            return True
+        if self.policy == "disconnect":
+            return False
+
+        # The pending pages are merged into one, the shared serializations are only lost for slow subscribers
+        graph = [e for m in self.messages for e in m.page.get("@graph", ())]
+        if self.policy == "coalesce":
+            latest = {}
+            for position, e in enumerate(graph):
+                latest[connection_id(e)] = position
+            STATS["coalesced"] += len(graph) - len(latest)
+            graph = [graph[p] for p in sorted(latest.values())]
+        if len(graph) > self.capacity:
+            STATS["dropped"] += len(graph) - self.capacity
+            graph = graph[len(graph) - self.capacity:]
+        page = dict(self.messages[0].page)
+        page["@graph"] = graph
+        self.messages = collections.deque([PushMessage(page, self.messages[0].cursor)])
+        self.events = len(graph)
+        return True
+
+    async def get(self):
+        # The next page, None once the buffer is closed and drained
+        while len(self.messages) == 0:
+            if self.closed:
+                return None
+            self.available.clear()
+            await self.available.wait()
+        message = self.messages.popleft()
+        self.events -= len(message.page.get("@graph", ()))
+        return message
+
+    def cursor(self):
+        # Where a subscriber resumes when none of the pending pages are written
+        return self.messages[0].cursor if len(self.messages) > 0 else None
+
+    def close(self, message=None):
+        # The pending pages are dropped, a last message can still be written
+        self.messages.clear()
+        self.events = 0
+        if message is not None:
+            self.messages.append(message)
+        self.closed = True
+        self.available.set()
+
+    def __len__(self):
+        return len(self.messages)
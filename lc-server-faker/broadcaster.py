@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import bisect
+import logging
+import tornado.ioloop
+from events import create_events_page
+from helpers import seconds_of_day
+from instrumentation import FANOUT_LAG
+from serialization import PushMessage
+from scheduler import EventScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class EventBroadcaster(object):
+    def __init__(self, event_index, clock, latest_state):
+        self.event_index = event_index
+        self.clock = clock
+        # Compacting subscribers get the latest event of every connection instead
+        self.latest_state = latest_state
+        # Subscribers are grouped by their cursor: a result time and the number of events of that second they
+        # already received, so events which arrive late for a second are still pushed
+        self.groups = {}
+        self.cursors = {}
+        self.last_check = None
+        # Only wake up when the next event is due instead of polling
+        self.scheduler = EventScheduler(event_index, self._check_for_new_events, clock)
+
+    def register(self, subscriber, last_sync_time):
+        cursor = (seconds_of_day(last_sync_time), 0)
+        self.groups.setdefault(cursor, set()).add(subscriber)
+        self.cursors[subscriber] = cursor
+        self.scheduler.start()
+        # Catch up on the events since lastSyncTime right away
+        tornado.ioloop.IOLoop.current().add_callback(self._check_for_new_events)
+
+    def unregister(self, subscriber):
+        cursor = self.cursors.pop(subscriber, None)
+        if cursor is None:
+            return
+        group = self.groups[cursor]
+        group.discard(subscriber)
+        if not group:
+            del self.groups[cursor]
+        if not self.cursors:
+            self.scheduler.stop()
+
+    def __len__(self):
+        return len(self.cursors)
+
+    def _check_for_new_events(self):
+        now_date = self.clock.now()
+        now = seconds_of_day(now_date)
+
+        # Only the time is used, start over when the day rolled over
+        previous_check = self.last_check
+        if previous_check is not None and now < previous_check:
+            self.groups = {(0, 0): set(self.cursors)}
+            previous_check = None
+        self.last_check = now
+        keys = self.event_index.keys
+        latest = (now, bisect.bisect_right(keys, now) - bisect.bisect_left(keys, now))
+
+        # Each batch is computed and serialized once per group and shared by all its subscribers
+        for cursor, subscribers in list(self.groups.items()):
+            if cursor >= latest:
+                continue
+            start, skip = cursor
+            target_date = now_date.replace(hour=start // 3600, minute=start // 60 % 60, second=start % 60,
+                                           microsecond=0)
+            messages = {}
+            for s in list(subscribers):
+                if s.compact not in messages:
+                    state = self.latest_state if s.compact else self.event_index
+                    graph, _ = state.page(start, skip, now, len(self.event_index))
+                    logger.debug("Found %d events for %d subscribers", len(graph), len(subscribers))
+                    messages[s.compact] = PushMessage(create_events_page(target_date, graph), cursor) \
+                        if len(graph) > 0 else None
+                if messages[s.compact] is not None:
+                    s._send(messages[s.compact])
+
+        # Lag of the events which became due since the last check, now that every subscriber has them
+        if previous_check is not None:
+            sent = self.clock.seconds_of_day()
+            for key in keys[bisect.bisect_right(keys, previous_check):bisect.bisect_right(keys, now)]:
+                FANOUT_LAG.observe(self.clock.delay(max(sent - key, 0.0)))
+
+        # Everyone who is up to date ends up in the same group
+        merged = set()
+        for cursor in [c for c in self.groups if c <= latest]:
+            merged.update(self.groups.pop(cursor))
+        if len(merged) > 0:
+            self.groups.setdefault(latest, set()).update(merged)
+            for s in merged:
+                self.cursors[s] = latest
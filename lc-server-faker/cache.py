@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import collections
+import gzip
+from constants import *
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ["br", "gzip", "identity"] if brotli is not None else ["gzip", "identity"]
+
+
+def negotiate_encoding(accept_encoding, encodings=ENCODINGS):
+    # Pick the best encoding we can serve, honouring q=0 exclusions
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 1.0 if encoding == "identity" else 0.0))
+        if quality > 0:
+            return encoding
+    return "identity"
+
+
+def cache_control(clock, immutable):
+    # Planned data only changes again when the simulated day rolls over, live data is always revalidated
+    max_age = min(CACHE_MAX_AGE, clock.delay(24 * 3600 - clock.seconds_of_day())) if immutable else 0
+    return "public, max-age={0}".format(int(max_age)) if max_age > 0 else "no-cache"
+
+
+def _size(entry):
+    # Slices of a memory-mapped dataset live in the page cache, not in our budget
+    return sum(len(b) for b in entry.values() if not isinstance(b, memoryview))
+
+
+def _compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, 9)
+    if encoding == "br":
+        return brotli.compress(body, quality=9)
+    return body
+
+
+class FragmentCache(object):
+    def __init__(self, max_size=FRAGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, encoding, render):
+        # Serialize a fragment once, compressed variants are added on demand
+        entry = self.entries.get(key)
+        if entry is not None and encoding in entry:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[encoding]
+
+        self.misses += 1
+        if entry is None:
+            entry = {"identity": render()}
+            self.entries[key] = entry
+            self.size += _size(entry)
+        if encoding not in entry:
+            entry[encoding] = _compress(entry["identity"], encoding)
+            self.size += len(entry[encoding])
+        self.entries.move_to_end(key)
+        body = entry[encoding]
+        self._evict()
+        return body
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= _size(entry)
+
+    def _evict(self):
+        # Least recently used fragments go first until we fit in the budget again
+        while self.size > self.max_size and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= _size(entry)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size
+        }
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+
+import datetime
+import time
+from helpers import seconds_of_day
+
+
+class Clock(object):
+    def __init__(self, start=None, speed=1.0):
+        # Simulated UTC time, starts at `start` and runs `speed` times faster than the wall clock
+        self.origin = time.time()
+        self.start = start if start is not None else datetime.datetime.utcfromtimestamp(self.origin)
+        self.speed = speed
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=(time.time() - self.origin) * self.speed)
+
+    def seconds_of_day(self):
+        now = self.now()
+        return seconds_of_day(now) + now.microsecond / 1000000.0
+
+    def delay(self, seconds):
+        # Wall clock time until the given simulated time has passed
+        return seconds / self.speed
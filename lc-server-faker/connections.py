@@ -1,27 +1,90 @@
 #!/usr/bin/python3
 
+import dateutil.parser
+import hashlib
+import logging
 import tornado.web
-import os
-import datetime
-import dateutil
-import json
+from urllib.parse import urlencode
+from cache import cache_control, negotiate_encoding
+from model import ConnectionTable
+
+logger = logging.getLogger(__name__)
 
 
 class ConnectionsHandler(tornado.web.RequestHandler):
-    def initialize(self, supported_agencies):
+    def initialize(self, supported_agencies, fragment_store, fragment_cache, clock, calendar=None):
         self.supported_agencies = supported_agencies
-        self.files = []
-        for f in os.listdir("connections"):
-            path = os.path.join("connections", f)
-            if os.path.isfile(path):
-                self.files.append(path)
-        self.files.sort()
+        self.fragment_store = fragment_store
+        self.fragment_cache = fragment_cache
+        self.clock = clock
+        # Without a calendar the date is ignored and the same day is served on every date
+        self.calendar = calendar
 
     def get(self, agency):
         if agency in self.supported_agencies:
             departure_time = self.get_argument("departureTime")
-            print("Got departureTime: " + departure_time)
-            self.write(self._find_fragment(departure_time))
+            departure = dateutil.parser.parse(departure_time)
+            index = self._find_fragment(departure_time, departure)
+            filters = {name: self.get_argument(name) for name in ConnectionTable.INDEXED
+                       if self.get_argument(name, None) is not None}
+
+            # Only the current day is patched with the events, the other dates of the calendar are planned
+            date = None
+            live = True
+            if self.calendar is not None:
+                date = departure.date()
+                if date not in self.calendar:
+                    self.set_status(404)
+                    self.write(
+                        {
+                            "error": "No service on {0}".format(date.isoformat()),
+                            "status": 404
+                        }
+                    )
+                    return
+                live = date == self.clock.now().date()
+
+            # Every variant of the page gets its own validator, a match is answered with headers only
+            encoding = negotiate_encoding(self.request.headers.get("Accept-Encoding", ""))
+            etag = self.fragment_store.etag(index) if live else self.fragment_store.digest(index)
+            if date is not None:
+                etag += "-" + date.isoformat()
+            if len(filters) > 0:
+                etag += "-" + hashlib.blake2b(urlencode(sorted(filters.items())).encode("utf-8"),
+                                              digest_size=4).hexdigest()
+            if encoding != "identity":
+                etag += "-" + encoding
+            # Late events are patched into any page of the current day, so those are always revalidated
+            self.set_header("Etag", '"{0}"'.format(etag))
+            self.set_header("Cache-Control", cache_control(self.clock, not live))
+            self.set_header("Vary", "Accept-Encoding")
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+
+            # Hot fragments are written as cached bytes, without any JSON work
+            key = (index, self.fragment_store.versions[index] if live else None)
+            if date is not None:
+                key += (date,)
+                if len(filters) > 0:
+                    key += (tuple(sorted(filters.items())),)
+                    body = self.fragment_cache.get(key, encoding,
+                                                   lambda: self.calendar.filtered_body(date, index, live, filters))
+                else:
+                    body = self.fragment_cache.get(key, encoding, lambda: self.calendar.body(date, index, live))
+            elif len(filters) > 0:
+                key += (tuple(sorted(filters.items())),)
+                body = self.fragment_cache.get(key, encoding,
+                                               lambda: self.fragment_store.filtered_body(index, filters))
+            else:
+                body = self.fragment_cache.get(key, encoding, lambda: self.fragment_store.body(index))
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            if encoding != "identity":
+                self.set_header("Content-Encoding", encoding)
+            if isinstance(body, memoryview):
+                self._finish_view(body)
+            else:
+                self.finish(body)
         else:
             self.set_status(404)
             self.write(
@@ -31,26 +94,15 @@ class ConnectionsHandler(tornado.web.RequestHandler):
                 }
             )
 
-    def _find_fragment(self, departure_time):
-        target_date = dateutil.parser.parse(departure_time).replace(tzinfo=None)
-        target_file = None
-
-        for i in range(0, len(self.files) - 1):
-            current_file = self.files[i]
-            next_file = self.files[i + 1]
-            current_date = dateutil.parser.parse(os.path.basename(os.path.splitext(current_file)[0])).replace(
-                tzinfo=None)
-            next_date = dateutil.parser.parse(os.path.basename(os.path.splitext(next_file)[0])).replace(tzinfo=None)
-
-            # Ignore the date, only use the time
-            if current_date <= target_date.replace(year=current_date.year, month=current_date.month,
-                                                  day=current_date.day) < next_date:
-                print("Target date: {0}, between files: {1} and {2}".format(departure_time, current_file, next_file))
-                target_file = current_file
-                break
-
-        with open(target_file, "r") as json_file:
-            json_data = json.load(json_file)
-
-        # Return JSON data
-        return json_data
+    def _finish_view(self, body):
+        # Write the slice of the mapping straight to the stream, write() would copy it into bytes
+        self.set_header("Content-Length", len(body))
+        self.flush()
+        self.request.connection.write(body)
+        self.finish()
+
+    def _find_fragment(self, departure_time, departure):
+        # The pages only depend on the time, the calendar takes care of the date
+        index = self.fragment_store.find(departure)
+        logger.debug("Target date: %s, fragment: %s", departure_time, self.fragment_store.paths[index])
+        return index
@@ -2,16 +2,36 @@
 
 import datetime
 
-FRAGMENT_URL = "https://graph.irail.be/sncb/connections?departureTime={0}".format(datetime.datetime.utcnow()
-                                                                 .replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
-                                                                 .isoformat() + ".000Z")
+SOURCE_URL = "https://graph.irail.be"
+START_TIME = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)\
+                 .isoformat() + ".000Z"
+FRAGMENT_URL = "{0}/sncb/connections?departureTime={1}"
 STOP_TIME = (datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
             + datetime.timedelta(days=1)).isoformat() + "Z"
 EVENTS_FILE = "events/sncb.jsonld"
+EVENTS_LOG = "events/sncb.jsonl"
+EVENTS_COMPACTION_THRESHOLD = 10000
 NUMBER_OF_EVENTS = 10
 MAX_DELAY = 600
 STEP_DELAY = 60
 MAX_ADDITONAL_DELAY = 180
 ADDITIONAL_EVENT_TIME = 120
 PORT = 8080
+WORKERS = 1
+LOG_LEVEL = "INFO"
+SPEED = 1.0
+PAGE_SIZE = None
+PAGE_WINDOW = None
+EVENTS_PAGE_SIZE = 500
+EVENTS_CHUNK_SIZE = 50
+SUBSCRIBER_BUFFER = 1000
+SUBSCRIBER_POLICY = "coalesce"
+LATEST_CHECKPOINT_INTERVAL = 300
+DATASET_FILE = "events/sncb.pack"
+FETCH_RANGES = 8
+FETCH_CONCURRENCY = 4
+FETCH_RETRIES = 3
 SUPPORTED_AGENCIES = ["sncb"]
+FRAGMENT_CACHE_SIZE = 64 * 1024 * 1024
+CACHE_MAX_AGE = 3600
+CALENDAR_WEEKS = None
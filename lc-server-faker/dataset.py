@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+
+import argparse
+import bisect
+import dateutil.parser
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from eventindex import event_key
+from helpers import seconds_of_day
+from model import ConnectionTable, format_time, parse_time
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LCFAKER4"
+# Magic, number of fragments and connections, then offset and length of every section
+HEADER = struct.Struct("<8sQQ" + "QQ" * 11)
+SECTIONS = ["keys", "offsets", "lengths", "names", "hashes", "locations", "uris", "events", "event_keys",
+            "event_offsets", "meta"]
+DAY = 24 * 3600
+
+
+def connection_hash(connection_id):
+    # Stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(connection_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def fingerprint(directory, events_path):
+    # Names, sizes and modification times of the inputs, the event logs are replayed on every start anyway
+    fingerprints = {}
+    for name, paths in [("connections", [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+                                         if f.endswith(".jsonld")]),
+                        ("events", [events_path])]:
+        digest = hashlib.blake2b(digest_size=16)
+        for p in paths:
+            stat = os.stat(p)
+            digest.update("{0}\0{1}\0{2}\n".format(p, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+        fingerprints[name] = digest.hexdigest()
+    return fingerprints
+
+
+def write_dataset(path, directory, events_path, page_size=None, page_window=None):
+    meta = {"fingerprint": fingerprint(directory, events_path), "page_size": page_size, "page_window": page_window}
+
+    # Fragments sorted by the time of day they start, like the FragmentStore
+    fragments = []
+    for f in os.listdir(directory):
+        if f.endswith(".jsonld"):
+            start = dateutil.parser.parse(os.path.splitext(f)[0])
+            with open(os.path.join(directory, f), "rb") as json_file:
+                fragments.append((seconds_of_day(start), os.path.join(directory, f), json_file.read()))
+    fragments.sort(key=lambda f: f[0])
+    if page_size is not None or page_window is not None:
+        fragments = repaginate(fragments, page_size, page_window)
+
+    # The fragments are found by bisecting their keys, every time of day can only start one fragment
+    for (key, name, _), (next_key, next_name, _) in zip(fragments, fragments[1:]):
+        if key >= next_key:
+            raise ValueError("Fragments {0} and {1} start at the same time of day".format(name, next_name))
+
+    # The URIs are interned up front, so the stop tables are complete before the first request
+    locations = []
+    uris = {}
+    for index, (_, _, body) in enumerate(fragments):
+        for c in json.loads(body.decode("utf-8"))["@graph"]:
+            locations.append((connection_hash(c["@id"]), index))
+            for key, _ in ConnectionTable.CODED:
+                if key in c:
+                    uris.setdefault(c[key], None)
+    locations.sort()
+
+    sections = {
+        "keys": array("i", [k for k, _, _ in fragments]).tobytes(),
+        "names": "\n".join(p for _, p, _ in fragments).encode("utf-8"),
+        "hashes": array("Q", [h for h, _ in locations]).tobytes(),
+        "locations": array("i", [i for _, i in locations]).tobytes(),
+        "uris": "\n".join(uris).encode("utf-8"),
+        "meta": json.dumps(meta).encode("utf-8")
+    }
+    _write(path, [b for _, _, b in fragments], sections, events_path)
+    logger.info("Packed %d fragments and %d connections in %s", len(fragments), len(locations), path)
+
+
+def repaginate(fragments, page_size=None, page_window=None):
+    # Rebuild the pages from all connections, with at most page_size connections or page_window minutes per page
+    header = None
+    connections = []
+    for _, _, body in fragments:
+        fragment = json.loads(body.decode("utf-8"))
+        connections.extend(fragment.pop("@graph"))
+        if header is None:
+            header = fragment
+    if len(connections) == 0:
+        return fragments
+    times = [parse_time(c["departureTime"]) for c in connections]
+    order = sorted(range(0, len(connections)), key=lambda i: times[i])
+    day = times[order[0]] - times[order[0]] % DAY
+
+    # Pages start at the departureTime of their first connection, or at the start of their window. Connections
+    # departing at the same time stay on the same page, so the start times stay unique. Connections after
+    # midnight stay on the last page of the day, a page of the next day would wrap to the first keys.
+    pages = []
+    for i in order:
+        if len(pages) > 0 and times[i] >= day + DAY:
+            pass
+        elif page_window is not None:
+            start = day + (times[i] - day) // (page_window * 60) * page_window * 60
+            if len(pages) == 0 or pages[-1][0] != start:
+                pages.append((start, []))
+        elif len(pages) == 0 or (len(pages[-1][1]) >= page_size and times[pages[-1][1][-1]] != times[i]):
+            pages.append((times[i], []))
+        pages[-1][1].append(i)
+
+    # The server ignores the date, so the first and the last page link to each other a day apart
+    base = header["@id"].split("?")[0] + "?departureTime="
+    repaginated = []
+    for p, (start, rows) in enumerate(pages):
+        page = dict(header)
+        page["@id"] = base + format_time(start)
+        page["hydra:next"] = base + format_time(pages[p + 1][0] if p + 1 < len(pages) else pages[0][0] + DAY)
+        page["hydra:previous"] = base + format_time(pages[p - 1][0] if p > 0 else pages[-1][0] - DAY)
+        page["@graph"] = [connections[i] for i in rows]
+        repaginated.append((start % DAY, format_time(start), json.dumps(page).encode("utf-8")))
+    return repaginated
+
+
+def refresh_dataset(path, directory, events_path, page_size=None, page_window=None):
+    # Pack again when the fragments, the pagination or the events snapshot changed since the last time
+    meta = {"fingerprint": fingerprint(directory, events_path), "page_size": page_size, "page_window": page_window}
+    packed = _meta(path)
+    if packed == meta:
+        return
+    if packed is None or packed["fingerprint"]["connections"] != meta["fingerprint"]["connections"] \
+            or packed["page_size"] != page_size or packed["page_window"] != page_window:
+        write_dataset(path, directory, events_path, page_size, page_window)
+    else:
+        # Only the events changed, the packed fragments and their indexes are copied as they are
+        dataset = SharedDataset(path)
+        bodies = [dataset.fragment(index) for index in range(0, len(dataset))]
+        sections = {name: dataset.sections[name] for name in ["keys", "names", "hashes", "locations", "uris"]}
+        sections["meta"] = json.dumps(meta).encode("utf-8")
+        _write(path, bodies, sections, events_path)
+        logger.info("Updated the events in %s", path)
+
+
+def is_current(path, directory, events_path, page_size=None, page_window=None):
+    # The pack is a snapshot of everything built at startup, it is reused as long as the inputs are unchanged
+    try:
+        meta = {"fingerprint": fingerprint(directory, events_path), "page_size": page_size, "page_window": page_window}
+    except OSError:
+        return False
+    return _meta(path) == meta
+
+
+def _meta(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        return json.loads(bytes(SharedDataset(path).sections["meta"]).decode("utf-8"))
+    except (ValueError, struct.error):
+        # Packed by another version
+        return None
+
+
+def _write(path, bodies, sections, events_path):
+    # Events are stored sorted with their keys, so they are not parsed again when indexing. Every event is
+    # serialized on its own, so a single event can be decoded from the mapping.
+    with open(events_path, "r") as json_file:
+        events = sorted(((event_key(e), e) for e in json.load(json_file)), key=lambda k: k[0])
+    serialized = [json.dumps(e).encode("utf-8") for _, e in events]
+    event_offsets = [0]
+    for body in serialized:
+        event_offsets.append(event_offsets[-1] + len(body))
+    sections["events"] = b"".join(serialized)
+    sections["event_keys"] = array("i", [k for k, _ in events]).tobytes()
+    sections["event_offsets"] = array("Q", event_offsets).tobytes()
+    sections["lengths"] = array("Q", [len(b) for b in bodies]).tobytes()
+
+    # Fragment bodies are stored back to back after the header, the other sections follow them
+    position = HEADER.size
+    offsets = []
+    for body in bodies:
+        offsets.append(position)
+        position += len(body)
+    sections["offsets"] = array("Q", offsets).tobytes()
+
+    layout = []
+    paddings = []
+    for name in SECTIONS:
+        paddings.append(-position % 8)
+        position += paddings[-1]
+        layout.extend([position, len(sections[name])])
+        position += len(sections[name])
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as dataset_file:
+        dataset_file.write(HEADER.pack(MAGIC, len(bodies), len(sections["hashes"]) // 8, *layout))
+        for body in bodies:
+            dataset_file.write(body)
+        for name, padding in zip(SECTIONS, paddings):
+            dataset_file.write(b"\0" * padding)
+            dataset_file.write(sections[name])
+    os.replace(tmp_path, path)
+
+
+class SharedDataset(object):
+    def __init__(self, path):
+        # Read-only mapping: every process which maps the file shares the same pages
+        self.path = path
+        with open(path, "rb") as dataset_file:
+            self.map = mmap.mmap(dataset_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        fields = HEADER.unpack_from(self.map, 0)
+        if fields[0] != MAGIC:
+            raise ValueError("Not a dataset file: {0}".format(path))
+        self.sections = {}
+        for i, name in enumerate(SECTIONS):
+            offset, length = fields[3 + 2 * i], fields[4 + 2 * i]
+            self.sections[name] = self.view[offset:offset + length]
+        self.keys = self.sections["keys"].cast("i")
+        self.offsets = self.sections["offsets"].cast("Q")
+        self.lengths = self.sections["lengths"].cast("Q")
+        self.hashes = self.sections["hashes"].cast("Q")
+        self.locations = self.sections["locations"].cast("i")
+        self.event_keys = self.sections["event_keys"].cast("i")
+        self.event_offsets = self.sections["event_offsets"].cast("Q")
+        self.names = bytes(self.sections["names"]).decode("utf-8").split("\n")
+        self.uris = bytes(self.sections["uris"]).decode("utf-8").split("\n") if len(self.sections["uris"]) > 0 else []
+
+    def fragment(self, index):
+        # Zero-copy slice of the serialized fragment
+        return self.view[self.offsets[index]:self.offsets[index] + self.lengths[index]]
+
+    def locate(self, connection_id):
+        # Fragments which may hold the connection, hash collisions are resolved by the caller
+        h = connection_hash(connection_id)
+        position = bisect.bisect_left(self.hashes, h)
+        candidates = []
+        while position < len(self.hashes) and self.hashes[position] == h:
+            candidates.append(self.locations[position])
+            position += 1
+        return candidates
+
+    def event(self, index):
+        return json.loads(bytes(self.sections["events"][self.event_offsets[index]:self.event_offsets[index + 1]])
+                          .decode("utf-8"))
+
+    def __len__(self):
+        return len(self.keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the fragments and events in a single memory-mappable file.")
+    parser.add_argument("-d", "--directory",
+                        default="connections",
+                        help="Directory with the fragments.")
+    parser.add_argument("-e", "--events",
+                        default=EVENTS_FILE,
+                        help="Events snapshot.")
+    parser.add_argument("-o", "--output",
+                        default=DATASET_FILE,
+                        help="Packed dataset.")
+    parser.add_argument("-ps", "--pagesize",
+                        default=PAGE_SIZE,
+                        type=int,
+                        help="Repaginate with this number of connections per page.")
+    parser.add_argument("-pw", "--pagewindow",
+                        default=PAGE_WINDOW,
+                        type=int,
+                        help="Repaginate with pages covering this number of minutes.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    write_dataset(args.output, args.directory, args.events, args.pagesize, args.pagewindow)
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+import bisect
+import dateutil.parser
+import glob
+import heapq
+import json
+import logging
+import os
+from helpers import seconds_of_day
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+
+def log_files(log_path):
+    # The log of a single process and the logs of the workers, events/sncb.jsonl and events/sncb.<n>.jsonl
+    base = os.path.splitext(log_path)[0]
+    return sorted(set(glob.glob(base + ".jsonl") + glob.glob(base + ".*.jsonl")))
+
+
+def event_key(event):
+    # Events are indexed by the second of the day of their result time, the date is ignored when serving
+    return seconds_of_day(dateutil.parser.parse(event["sosa:resultTime"]))
+
+
+def validate_event(event):
+    # Everything the index, the static pages and the subscribers rely on, raises ValueError otherwise
+    if not isinstance(event, dict):
+        raise ValueError("Event is not an object")
+    if not isinstance(event.get("sosa:resultTime"), str):
+        raise ValueError("Event without sosa:resultTime")
+    try:
+        event_key(event)
+    except OverflowError as e:
+        raise ValueError("Invalid sosa:resultTime: {0}".format(e))
+    result = event.get("sosa:hasResult")
+    connection = result.get("Connection") if isinstance(result, dict) else None
+    if not isinstance(connection, dict) or not isinstance(connection.get("@id"), str):
+        raise ValueError("Event without sosa:hasResult.Connection.@id")
+
+
+def connection_id(event):
+    return event.get("sosa:hasResult", {}).get("Connection", {}).get("@id", event.get("@id"))
+
+
+class EventList(object):
+    def __init__(self, dataset=None, items=None):
+        # Events of the packed dataset are kept as their position in the shared mapping and decoded when they
+        # are read, so the workers do not each hold a copy. Events added afterwards are kept as they are.
+        self.dataset = dataset
+        self.items = items if items is not None else []
+
+    def insert(self, position, event):
+        self.items.insert(position, event)
+
+    def copy(self):
+        return EventList(self.dataset, list(self.items))
+
+    def _decode(self, item):
+        return self.dataset.event(item) if isinstance(item, int) else item
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._decode(item) for item in self.items[index]]
+        return self._decode(self.items[index])
+
+    def __iter__(self):
+        for item in self.items:
+            yield self._decode(item)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class EventIndex(object):
+    def __init__(self, path=EVENTS_FILE, log_path=EVENTS_LOG, dataset=None):
+        self.path = path
+        self.log_path = log_path
+        self.dataset = dataset
+        self.keys = []
+        self.events = EventList(dataset)
+        self.listeners = []
+        self.load()
+
+    def load(self):
+        # A packed dataset holds the events sorted with their keys, otherwise every result time is parsed once
+        if self.dataset is not None:
+            snapshot = list(zip(self.dataset.event_keys, range(0, len(self.dataset.event_keys))))
+        else:
+            with open(self.path, "r") as json_file:
+                snapshot = sorted(((event_key(e), e) for e in json.load(json_file)), key=lambda k: k[0])
+
+        # Replay the events which were appended after the last compaction
+        logged = []
+        for log_path in log_files(self.log_path):
+            with open(log_path, "r") as log_file:
+                for line in log_file:
+                    if not line.strip():
+                        continue
+                    try:
+                        logged.append(json.loads(line))
+                    except ValueError:
+                        # Torn write at the end of the log
+                        break
+
+        events = list(heapq.merge(snapshot, sorted(((event_key(e), e) for e in logged), key=lambda k: k[0]),
+                                  key=lambda k: k[0]))
+        self.keys = [k for k, _ in events]
+        self.events = EventList(self.dataset, [e for _, e in events])
+        logger.info("Indexed %d events", len(self.events))
+
+    def add(self, event):
+        # Keep the arrays sorted, events with the same result time stay in arrival order
+        key = event_key(event)
+        position = bisect.bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.events.insert(position, event)
+        for listener in self.listeners:
+            listener([key], [event])
+
+    def extend(self, events):
+        # Merge a sorted batch in one pass instead of inserting the events one by one
+        batch = sorted(((event_key(e), e) for e in events), key=lambda k: k[0])
+        if len(batch) == 0:
+            return
+        merged = list(heapq.merge(zip(self.keys, self.events.items), batch, key=lambda k: k[0]))
+        self.keys = [k for k, _ in merged]
+        self.events = EventList(self.dataset, [e for _, e in merged])
+        for listener in self.listeners:
+            listener([k for k, _ in batch], [e for _, e in batch])
+
+    def window(self, start, end):
+        # All events with start <= result time <= end, both in seconds of the day
+        return self.events[bisect.bisect_left(self.keys, start):bisect.bisect_right(self.keys, end)]
+
+    def count(self, start, end):
+        # Number of events with start <= result time <= end
+        return bisect.bisect_right(self.keys, end) - bisect.bisect_left(self.keys, start)
+
+    def page(self, start, skip, end, limit):
+        # At most limit events from the cursor (result time, events of that second already returned) up to end,
+        # with the cursor right after the last returned event
+        first = min(bisect.bisect_left(self.keys, start) + skip, bisect.bisect_right(self.keys, start))
+        last = min(first + limit, bisect.bisect_right(self.keys, end))
+        if last <= first:
+            return [], (start, skip)
+        key = self.keys[last - 1]
+        return self.events[first:last], (key, last - bisect.bisect_left(self.keys, key))
+
+    def __len__(self):
+        return len(self.events)
+
+
+class LatestState(object):
+    def __init__(self, event_index, interval=LATEST_CHECKPOINT_INTERVAL):
+        # Checkpoint at the end of every interval of result times: the latest event of every connection up to
+        # that time, sorted by result time. Built on first use from the previous checkpoint.
+        self.event_index = event_index
+        self.interval = interval
+        self.checkpoints = {}
+        event_index.listeners.append(self._invalidate)
+
+    def page(self, start, skip, end, limit):
+        # Like EventIndex.page, but only the latest event of every connection. Pages end on a whole second and
+        # the cursor skips all events of that second: the other events of the window are on a later page, or are
+        # replaced by a later event of their connection.
+        entries = self._latest(start, skip, end)
+        if len(entries) == 0:
+            return [], (start, skip)
+        last = min(limit, len(entries))
+        while last < len(entries) and entries[last][0] == entries[last - 1][0]:
+            last += 1
+        key = entries[last - 1][0]
+        keys = self.event_index.keys
+        return [e for _, e in entries[:last]], (key, bisect.bisect_right(keys, key) - bisect.bisect_left(keys, key))
+
+    def _latest(self, start, skip, end):
+        # Latest event of every connection with start <= result time <= end, without the first skip events of
+        # start, sorted by result time. Only the connections which changed since start are read from the
+        # checkpoint, the events after it are scanned.
+        checkpoint = (end + 1) // self.interval - 1
+        boundary = (checkpoint + 1) * self.interval - 1
+        if checkpoint < 0 or boundary <= start:
+            latest = self._scan(start, skip, end)
+        else:
+            keys, events = self._checkpoint(checkpoint)
+            latest = self._scan(start, skip, start) if skip > 0 else {}
+            for i in range(bisect.bisect_left(keys, start) if skip == 0 else bisect.bisect_right(keys, start),
+                           len(keys)):
+                latest[connection_id(events[i])] = (keys[i], events[i])
+            latest.update(self._scan(boundary + 1, 0, end))
+        return sorted(latest.values(), key=lambda k: k[0])
+
+    def _checkpoint(self, checkpoint):
+        # Missing checkpoints are built forward from the last one before them
+        first = checkpoint
+        while first >= 0 and first not in self.checkpoints:
+            first -= 1
+        for c in range(first + 1, checkpoint + 1):
+            previous = self.checkpoints[c - 1] if c > 0 else ([], [])
+            latest = {connection_id(e): (k, e) for k, e in zip(*previous)}
+            latest.update(self._scan(c * self.interval, 0, (c + 1) * self.interval - 1))
+            entries = sorted(latest.values(), key=lambda k: k[0])
+            self.checkpoints[c] = ([k for k, _ in entries], [e for _, e in entries])
+        return self.checkpoints[checkpoint]
+
+    def _scan(self, start, skip, end):
+        keys = self.event_index.keys
+        events = self.event_index.events
+        first = min(bisect.bisect_left(keys, start) + skip, bisect.bisect_right(keys, start))
+        latest = {}
+        for i in range(first, bisect.bisect_right(keys, end)):
+            latest[connection_id(events[i])] = (keys[i], events[i])
+        return latest
+
+    def _invalidate(self, keys, events):
+        # Events which arrive late change their own checkpoint and every later one
+        if len(keys) == 0 or len(self.checkpoints) == 0:
+            return
+        first = min(keys) // self.interval
+        for checkpoint in [c for c in self.checkpoints if c >= first]:
+            del self.checkpoints[checkpoint]
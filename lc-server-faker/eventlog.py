@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import queue
+import threading
+import tornado.concurrent
+import tornado.ioloop
+from eventindex import log_files
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+_COMPACT = object()
+_STOP = object()
+
+
+class EventLog(object):
+    def __init__(self, event_index, path=EVENTS_LOG, snapshot_path=EVENTS_FILE,
+                 compaction_threshold=EVENTS_COMPACTION_THRESHOLD):
+        self.event_index = event_index
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.compaction_threshold = compaction_threshold
+        self.appended = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, name="event-log-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        # Fold the events of a previous run into the snapshot
+        if any(os.path.getsize(p) > 0 for p in log_files(self.path)):
+            self.compact()
+
+    def stop(self):
+        self.queue.put((_STOP, None, None))
+        self.thread.join()
+
+    def append(self, events):
+        # Resolves once the events are durable, concurrent appends share a single fsync
+        future = tornado.concurrent.Future()
+        if len(events) == 0:
+            # Nothing to write, an empty line would end the replay of the log
+            future.set_result(None)
+            return future
+        self.queue.put(([json.dumps(e) for e in events], future, tornado.ioloop.IOLoop.current()))
+        self.appended += len(events)
+        if self.compaction_threshold is not None and self.appended >= self.compaction_threshold:
+            self.compact()
+        return future
+
+    def compact(self):
+        # The index already holds every event queued before this point, sorted by result time
+        self.appended = 0
+        self.queue.put((_COMPACT, self.event_index.events.copy(), None))
+
+    def _write_loop(self):
+        # Every batch is a single append, so the logs of several processes never interleave within a line
+        log_file = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            commits = []
+            for entry, future, io_loop in batch:
+                if entry is _STOP:
+                    running = False
+                    continue
+                if entry is _COMPACT:
+                    self._commit(log_file, lines, commits)
+                    lines = []
+                    commits = []
+                    os.close(log_file)
+                    self._write_snapshot(future)
+                    log_file = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+                    continue
+                lines.extend(entry)
+                commits.append((future, io_loop))
+            self._commit(log_file, lines, commits)
+        os.close(log_file)
+
+    def _commit(self, log_file, lines, commits):
+        if len(commits) == 0:
+            return
+        error = None
+        try:
+            if len(lines) > 0:
+                os.write(log_file, ("\n".join(lines) + "\n").encode("utf-8"))
+                os.fsync(log_file)
+        except OSError as e:
+            logger.error("Writing events FAILED: %s", e)
+            error = e
+        for future, io_loop in commits:
+            if error is None:
+                io_loop.add_callback(tornado.concurrent.future_set_result_unless_cancelled, future, None)
+            else:
+                io_loop.add_callback(tornado.concurrent.future_set_exc_info, future,
+                                     (type(error), error, error.__traceback__))
+
+    def _write_snapshot(self, events):
+        # Replace the sorted snapshot atomically, the log is truncated afterwards
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(list(events), json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # The snapshot holds the events of all logs now
+        for log_path in log_files(self.path):
+            if log_path != self.path:
+                os.remove(log_path)
+        logger.info("Compacted %d events", len(events))
@@ -2,222 +2,352 @@
 
 import tornado.web
 import tornado.locks
-import tornadose.handlers
-import tornadose.stores
+import tornado.websocket
 import dateutil
 import datetime
 import json
-import signal
+import logging
 import abc
+import base64
+import binascii
+import hashlib
+import tornado.ioloop
+import tornado.iostream
+from backpressure import STATS, SubscriberBuffer
+from eventindex import validate_event
+from helpers import seconds_of_day
+from serialization import BINARY_FORMATS, FORMATS, PushMessage
+from scheduler import EventScheduler
 from constants import *
 
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(key, skip):
+    return base64.urlsafe_b64encode("{0}.{1}".format(key, skip).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    try:
+        key, skip = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split(".")
+        key, skip = int(key), int(skip)
+    except (TypeError, UnicodeDecodeError, binascii.Error, ValueError) as e:
+        raise ValueError("Invalid cursor: {0}".format(e))
+    if key < 0 or skip < 0:
+        raise ValueError("Invalid cursor: negative position")
+    return key, skip
+
+
+def create_events_page(target_date, graph):
+    events = {
+        "@context": {
+        "xsd": "http://www.w3.org/2001/XMLSchema#",
+        "lc": "http://semweb.mmlab.be/ns/linkedconnections#",
+        "hydra": "http://www.w3.org/ns/hydra/core#",
+        "gtfs": "http://vocab.gtfs.org/terms#",
+        "sosa": "http://www.w3.org/ns/sosa#",
+        "Event": "sosa:Observation",
+        "Connection": "lc:Connection",
+        "CancelledConnection": "lc:CancelledConnection",
+        "arrivalTime": {
+            "@id": "lc:arrivalTime",
+            "@type": "xsd:dateTime"
+        },
+        "departureTime": {
+            "@id": "lc:departureTime",
+            "@type": "xsd:dateTime"
+        },
+        "arrivalStop": {
+            "@type": "@id",
+            "@id": "lc:arrivalStop"
+        },
+        "departureStop": {
+            "@type": "@id",
+            "@id": "lc:departureStop"
+        },
+        "departureDelay": {
+            "@id": "lc:departureDelay",
+            "@type": "xsd:integer"
+        },
+        "arrivalDelay": {
+            "@id": "lc:arrivalDelay",
+            "@type": "xsd:integer"
+        },
+        "direction": {
+            "@id": "gtfs:headsign",
+            "@type": "xsd:string"
+        },
+        "gtfs:trip": {
+            "@type": "@id"
+        },
+        "gtfs:route": {
+            "@type": "@id"
+        },
+        "gtfs:pickupType": {
+            "@type": "@id"
+        },
+        "gtfs:dropOffType": {
+            "@type": "@id"
+        },
+        "gtfs:Regular": {
+            "@type": "@id"
+        },
+        "gtfs:NotAvailable": {
+            "@type": "@id"
+        },
+        "hydra:next": {
+            "@type": "@id"
+        },
+        "hydra:previous": {
+            "@type": "@id"
+        },
+        "hydra:property": {
+            "@type": "@id"
+        },
+        "hydra:variableRepresentation": {
+                "@type": "@id"
+            }
+        },
+        "@id": "http://localhost:8080/sncb/events?lastSyncTime=",
+        "@type": "hydra:PartialCollectionView",
+        "hydra:next": "http://localhost:8080/sncb/events?lastSyncTime=",
+        "hydra:previous": "http://localhost:8080/sncb/events?lastSyncTime=",
+        "hydra:search": {
+            "@type": "hydra:IriTemplate",
+            "hydra:template": "http://localhost:8080/sncb/events{?lastSyncTime}",
+            "hydra:variableRepresentation": "hydra:BasicRepresentation",
+            "hydra:mapping": {
+                "@type": "IriTemplateMapping",
+                "hydra:variable": "departureTime",
+                "hydra:required": True,
+                "hydra:property": "lc:departureTimeQuery"
+            }
+        },
+        "@graph": []
+    }
+
+    hydra_next_date = target_date + datetime.timedelta(minutes=10)
+    hydra_previous_date = target_date - datetime.timedelta(minutes=10)
+    events["hydra:next"] = events["hydra:next"] + hydra_next_date.isoformat() + ".000Z"
+    events["hydra:previous"] = events["hydra:previous"] + hydra_previous_date.isoformat() + ".000Z"
+    events["@graph"] = graph
+    return events
+
 
 class _BaseEventsHandler(object):
     __metaclass__ = abc.ABCMeta
 
-    def initialize(self, supported_agencies):
+    def initialize(self, supported_agencies, event_index, clock):
         self.supported_agencies = supported_agencies
-        self.file = EVENTS_FILE
+        self.event_index = event_index
+        self.clock = clock
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
 
-    def _fetch_events(self, last_sync_time):
-        now_date = datetime.datetime.utcnow().replace(tzinfo=None)
-        try:
-            target_date = last_sync_time.replace(tzinfo=None)
-            if target_date > now_date:
-                raise ValueError("lastSyncTime must be before now")
-        except ValueError:
-            self.set_status(400)
-            return {
-                "error": "Target date is further than now",
-                "status": 400
-            }
-
-        events = {
-            "@context": {
-            "xsd": "http://www.w3.org/2001/XMLSchema#",
-            "lc": "http://semweb.mmlab.be/ns/linkedconnections#",
-            "hydra": "http://www.w3.org/ns/hydra/core#",
-            "gtfs": "http://vocab.gtfs.org/terms#",
-            "sosa": "http://www.w3.org/ns/sosa#",
-            "Event": "sosa:Observation",
-            "Connection": "lc:Connection",
-            "CancelledConnection": "lc:CancelledConnection",
-            "arrivalTime": {
-                "@id": "lc:arrivalTime",
-                "@type": "xsd:dateTime"
-            },
-            "departureTime": {
-                "@id": "lc:departureTime",
-                "@type": "xsd:dateTime"
-            },
-            "arrivalStop": {
-                "@type": "@id",
-                "@id": "lc:arrivalStop"
-            },
-            "departureStop": {
-                "@type": "@id",
-                "@id": "lc:departureStop"
-            },
-            "departureDelay": {
-                "@id": "lc:departureDelay",
-                "@type": "xsd:integer"
-            },
-            "arrivalDelay": {
-                "@id": "lc:arrivalDelay",
-                "@type": "xsd:integer"
-            },
-            "direction": {
-                "@id": "gtfs:headsign",
-                "@type": "xsd:string"
-            },
-            "gtfs:trip": {
-                "@type": "@id"
-            },
-            "gtfs:route": {
-                "@type": "@id"
-            },
-            "gtfs:pickupType": {
-                "@type": "@id"
-            },
-            "gtfs:dropOffType": {
-                "@type": "@id"
-            },
-            "gtfs:Regular": {
-                "@type": "@id"
-            },
-            "gtfs:NotAvailable": {
-                "@type": "@id"
-            },
-            "hydra:next": {
-                "@type": "@id"
-            },
-            "hydra:previous": {
-                "@type": "@id"
-            },
-            "hydra:property": {
-                "@type": "@id"
-            },
-            "hydra:variableRepresentation": {
-                    "@type": "@id"
-                }
-            },
-            "@id": "http://localhost:8080/sncb/events?lastSyncTime=",
-            "@type": "hydra:PartialCollectionView",
-            "hydra:next": "http://localhost:8080/sncb/events?lastSyncTime=",
-            "hydra:previous": "http://localhost:8080/sncb/events?lastSyncTime=",
-            "hydra:search": {
-                "@type": "hydra:IriTemplate",
-                "hydra:template": "http://localhost:8080/sncb/events{?lastSyncTime}",
-                "hydra:variableRepresentation": "hydra:BasicRepresentation",
-                "hydra:mapping": {
-                    "@type": "IriTemplateMapping",
-                    "hydra:variable": "departureTime",
-                    "hydra:required": True,
-                    "hydra:property": "lc:departureTimeQuery"
+    def _compact(self):
+        # Only the latest event of every connection in the window, instead of all its intermediate events
+        compact = self.get_query_argument("compact", "false")
+        if compact not in ["true", "false"]:
+            raise ValueError("Unsupported compact mode: {0}".format(compact))
+        return compact == "true"
+
+    def _since(self, last_sync_time):
+        # Only the events of the current day are known, a lastSyncTime on an earlier day gets all of them
+        today = self.clock.now().date()
+        if last_sync_time.replace(tzinfo=None).date() < today:
+            return datetime.datetime.combine(today, datetime.time())
+        return last_sync_time
+
+    def _fetch_events(self, last_sync_time, cursor, page_size, compact=False):
+        now_date = self.clock.now()
+        now = seconds_of_day(now_date)
+        if cursor is not None:
+            start, skip = decode_cursor(cursor)
+            # Cursors only hold the time, a cursor after now was handed out before the day rolled over
+            if start > now + 1:
+                start, skip = 0, 0
+        else:
+            if last_sync_time.replace(tzinfo=None) > now_date:
+                self.set_status(400)
+                return {
+                    "error": "Target date is further than now",
+                    "status": 400
                 }
-            },
-            "@graph": []
-        }
-
-        # Read pseudorandom events JSON-LD file
-        with open(self.file, "r") as json_file:
-            json_data = json.load(json_file)
+            start, skip = seconds_of_day(self._since(last_sync_time)), 0
 
         # Ignore the date, only use the time
-        target_date = target_date.replace(year=now_date.year,
-                                          month=now_date.month,
-                                          day=now_date.day)
-        hydra_next_date = target_date + datetime.timedelta(minutes=10)
-        hydra_previous_date = target_date - datetime.timedelta(minutes=10)
-        events["hydra:next"] = events["hydra:next"] + hydra_next_date.isoformat() + ".000Z"
-        events["hydra:previous"] = events["hydra:previous"] + hydra_previous_date.isoformat() + ".000Z"
-
-        # Sort the events by timestamp and filter them based on the sync time
-        json_data = sorted(json_data, key=lambda k: k["sosa:resultTime"])
-        for c in json_data:
-            current_date = dateutil.parser.parse(c["sosa:resultTime"]).replace(year=now_date.year,
-                                                                         month=now_date.month,
-                                                                         day=now_date.day,
-                                                                         tzinfo=None)
-            if target_date <= current_date <= now_date:
-                events["@graph"].append(c)
-
-        return events
-
-
-class _PushHandler(_BaseEventsHandler):
-    __metaclass__ = abc.ABCMeta
+        target_date = now_date.replace(hour=start // 3600, minute=start // 60 % 60, second=start % 60, microsecond=0)
 
-    def initialize(self, supported_agencies):
-        _BaseEventsHandler.initialize(self, supported_agencies)
-        # Start the event fetcher (1s) and stop it when shutting down
-        self.callback = tornado.ioloop.PeriodicCallback(self._check_for_new_events, 1000)
-        signal.signal(signal.SIGINT, self._shutdown)
-        self.last_event_timestamp = datetime.datetime.utcnow()
-
-    def _check_for_new_events(self):
-        e = self._fetch_events(self.last_event_timestamp)
-        if len(e["@graph"]) > 0:
-            print("Found {0} events".format(len(e["@graph"])))
-            self._send(e)
-            self.last_event_timestamp = datetime.datetime.utcnow()
+        # The index is sorted by result time, a bounded page is taken from the cursor on
+        if compact:
+            graph, (key, last_skip) = self.latest_state.page(start, skip, now, page_size)
         else:
-            print("No events yet")
+            graph, (key, last_skip) = self.event_index.page(start, skip, now, page_size)
+        page = create_events_page(target_date, graph)
+        page["@id"] = "http://localhost:8080/sncb/events?" + self.request.query
+        page["hydra:next"] = "http://localhost:8080/sncb/events?cursor=" + encode_cursor(key, last_skip) \
+            + ("&compact=true" if compact else "")
 
-    def _shutdown(self, sig, frame):
-        self._close()
+        # The page only changes when events are added between its bounds. Events can be posted for any result time,
+        # so even pages in the past are revalidated with the ETag instead of being cached for a while.
+        validator = "{0}.{1}.{2}.{3}.{4}.{5}.{6}".format(target_date.date(), start, skip, key, last_skip,
+                                                         self.event_index.count(start, key), compact)
+        self.set_header("Etag", '"{0}"'.format(hashlib.blake2b(validator.encode("utf-8"), digest_size=8).hexdigest()))
+        self.set_header("Cache-Control", "no-cache")
+        return page
 
-    @abc.abstractmethod
-    def _send(self, message):
-        raise NotImplementedError("You must implement the _send() method")
-
-    def _close(self):
-        print("Cleaning up")
-        self.callback.stop()
 
+class _PushHandler(_BaseEventsHandler):
+    __metaclass__ = abc.ABCMeta
 
-class EventsHandlerStatic(_PushHandler):
-    def initialize(self, supported_agencies):
-        _PushHandler.initialize(self. supported_agencies)
-        # Start the callback immediately
-        self.callback.start()
+    def initialize(self, supported_agencies, event_index, clock, broadcasters, buffer_size, buffer_policy):
+        _BaseEventsHandler.initialize(self, supported_agencies, event_index, clock)
+        # Events are fetched once by the broadcaster of the agency and pushed to all its subscribers
+        self.broadcasters = broadcasters
+        self.broadcaster = None
+        # Pages which are not written yet, bounded so slow subscribers cannot grow the memory
+        self.buffer = SubscriberBuffer(buffer_size, buffer_policy)
+        # Every subscriber picks its own format, the @context can be left out after the first page
+        self.format = "json"
+        self.context_once = False
+        self.context_sent = False
+        self.compact = False
+
+    def _negotiate(self, format, binary):
+        if format not in FORMATS or (format in BINARY_FORMATS and not binary):
+            raise ValueError("Unsupported format: {0}".format(format))
+        context = self.get_query_argument("context", "always")
+        if context not in ["always", "once"]:
+            raise ValueError("Unsupported context mode: {0}".format(context))
+        self.format = format
+        self.context_once = context == "once"
+        self.compact = self._compact()
+
+    def _encode(self, message):
+        body = message.body(self.format, not (self.context_once and self.context_sent))
+        self.context_sent = True
+        return body
+
+    def _subscribe(self, agency, last_sync_time):
+        if last_sync_time.replace(tzinfo=None) > self.clock.now():
+            raise ValueError("lastSyncTime must be before now")
+        self.broadcaster = self.broadcasters[agency]
+        self.broadcaster.register(self, self._since(last_sync_time))
 
     def _send(self, message):
-        print("Received new connections, updating static")
-        for c in message["@graph"]:
-            # Search for the page and the next page
+        # Called by the broadcaster, only one page is written at a time and the others wait in the buffer
+        if not self.buffer.put(message):
+            self._disconnect()
+
+    def _disconnect(self):
+        # Too slow: the pending pages are dropped, the subscriber gets a cursor to resume from instead
+        STATS["disconnected"] += 1
+        start, skip = self.buffer.cursor()
+        logger.warning("Disconnecting a slow subscriber at %d", start)
+        self._close()
+        self.buffer.close(PushMessage(
+            {
+                "error": "Subscriber too slow, resume from hydra:next",
+                "status": 503,
+                "hydra:next": "http://localhost:8080/sncb/events?cursor=" + encode_cursor(start, skip)
+            }
+        ))
 
-            # Update the connection if departureTime (including delay) < next page time
+    def queue_depth(self):
+        return len(self.buffer)
 
-            # Move connection to the next page if departureTime (including delay) <= next page time
+    def _close(self):
+        logger.debug("Cleaning up")
+        if self.broadcaster is not None:
+            self.broadcaster.unregister(self)
+            self.broadcaster = None
+
+
+class EventsHandlerStatic(object):
+    def __init__(self, event_index, fragment_store, fragment_cache, clock):
+        self.event_index = event_index
+        self.fragment_store = fragment_store
+        self.fragment_cache = fragment_cache
+        self.clock = clock
+        # Catch up on everything that happened today, then follow the events when they are due
+        self.cursor = 0
+        self.scheduler = EventScheduler(event_index, self._check_for_new_events, clock)
+
+    def start(self):
+        self.scheduler.start()
+        self.event_index.listeners.append(self._add_late_events)
+        tornado.ioloop.IOLoop.current().add_callback(self._check_for_new_events)
+
+    def _add_late_events(self, keys, events):
+        # Events with a result time before the cursor are never in a later window, they are patched right away
+        late = [e for k, e in zip(keys, events) if k < self.cursor]
+        if len(late) > 0:
+            self._send(late)
 
-            pass
+    def _check_for_new_events(self):
+        now = seconds_of_day(self.clock.now())
+
+        # Only the time is used, start over from the original pages when the day rolled over
+        if now + 1 < self.cursor:
+            self.fragment_store.reset()
+            self.cursor = 0
+
+        events = self.event_index.window(self.cursor, now)
+        self.cursor = now + 1
+        if len(events) > 0:
+            self._send(events)
+
+    def _send(self, events):
+        logger.debug("Received %d new connections, updating static", len(events))
+        connections = []
+        for e in events:
+            c = dict(e["sosa:hasResult"]["Connection"])
+            if "departureDelay" in e:
+                c["departureDelay"] = e["departureDelay"]
+            if "arrivalDelay" in e:
+                c["arrivalDelay"] = e["arrivalDelay"]
+            connections.append(c)
+
+        # Only the touched pages get a new version, the others keep their cached bodies
+        for index, version in self.fragment_store.patch(connections):
+            self.fragment_cache.discard((index, version))
 
 
 class EventsHandlerHTTP(_BaseEventsHandler, tornado.web.RequestHandler):
-    def get(self, agency):
+    def initialize(self, supported_agencies, event_index, clock, page_size, latest_state):
+        _BaseEventsHandler.initialize(self, supported_agencies, event_index, clock)
+        self.page_size = page_size
+        self.latest_state = latest_state
+
+    async def get(self, agency):
         # return HTTP if header is application/json, works fine
         # return SSE if header is text/event-stream, see https://gist.github.com/mivade/d474e0540036d873047f
         # return WS
         if agency in self.supported_agencies:
             try:
-                last_sync_time = self.get_argument("lastSyncTime")
-                last_sync_time = dateutil.parser.parse(last_sync_time)
-                e = self._fetch_events(last_sync_time)
-                if "@graph" in e:
-                    print("Found {0} HTTP polling events".format(len(e["@graph"])))
-                self.write(e)
-            except ValueError:
+                cursor = self.get_argument("cursor", None)
+                last_sync_time = None
+                if cursor is None:
+                    last_sync_time = dateutil.parser.parse(self.get_argument("lastSyncTime"))
+                e = self._fetch_events(last_sync_time, cursor, self.page_size, self._compact())
+            except ValueError as error:
                 self.set_status(400)
                 self.write(
                     {
-                        "error": "Incorrect datetime format: {0}".format(self.get_argument("lastSyncTime")),
+                        "error": "Incorrect lastSyncTime or cursor: {0}".format(error),
                         "status": 400
                     }
                 )
+                return
+            if "@graph" in e:
+                logger.debug("Found %d HTTP polling events", len(e["@graph"]))
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+                await self._write_page(e)
+            else:
+                self.write(e)
         else:
             self.set_status(404)
             self.write(
@@ -228,51 +358,122 @@ class EventsHandlerHTTP(_BaseEventsHandler, tornado.web.RequestHandler):
             )
 
 
-class EventsHandlerSSE(_PushHandler, tornadose.handlers.EventSource):
-    def initialize(self, supported_agencies):
-        _PushHandler.initialize(self, supported_agencies)
-        tornadose.handlers.EventSource.initialize(self, tornadose.stores.QueueStore())
+    async def _write_page(self, page):
+        # The events are serialized and flushed in chunks instead of building the whole body at once
+        graph = page.pop("@graph")
+        head = json.dumps(page)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(head[:-1] + ", \"@graph\": [")
+        for i in range(0, len(graph), EVENTS_CHUNK_SIZE):
+            self.write((", " if i > 0 else "") + ", ".join(json.dumps(e) for e in graph[i:i + EVENTS_CHUNK_SIZE]))
+            await self.flush()
+        self.write("]}")
+
+
+class EventsHandlerSSE(_PushHandler, tornado.web.RequestHandler):
+    def initialize(self, supported_agencies, event_index, clock, broadcasters, buffer_size, buffer_policy):
+        _PushHandler.initialize(self, supported_agencies, event_index, clock, broadcasters, buffer_size,
+                                buffer_policy)
+        self.finished = False
 
     async def get(self, agency):
         if agency in self.supported_agencies:
-            print("Registering client, setting lastSyncTime")
+            logger.debug("Registering client, setting lastSyncTime")
             try:
-                self.last_event_timestamp = dateutil.parser.parse(self.get_argument("lastSyncTime"))
-                self.callback.start()
-                await tornadose.handlers.EventSource.get(self)
+                self._negotiate(self.get_query_argument("format", "json"), False)
+                self._subscribe(agency, dateutil.parser.parse(self.get_argument("lastSyncTime")))
             except ValueError as e:
-                print("Invalid datetime: {0}".format(e))
+                logger.warning("Invalid request: %s", e)
                 self.set_status(400)
+                return
+            self.set_header("Content-Type", "text/event-stream")
+            self.set_header("Cache-Control", "no-cache")
+            try:
+                # Only one page is written at a time, the others wait in the bounded buffer
+                while not self.finished:
+                    await self.publish(await self.buffer.get())
+            finally:
+                self._close()
         else:
             self.set_status(404)
-            self.store.submit(
+            self.write(
                 {
                     "error": "Unsupported agency: {0}".format(agency),
                     "status": 404
                 }
             )
 
-    def _shutdown(self, sig, frame):
+    def on_connection_close(self):
+        self.finished = True
         self._close()
-
-    def _send(self, message):
-        self.store.submit(message)
+        self.buffer.close()
+
+    async def publish(self, message):
+        # Server-sent events framing
+        if message is None:
+            # The buffer was closed
+            self.finished = True
+            return
+        try:
+            self.write("data: {0}\n\n".format(self._encode(message)))
+            await self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.finished = True
 
 
 class EventsHandlerWS(_PushHandler, tornado.websocket.WebSocketHandler):
+    def initialize(self, supported_agencies, event_index, clock, broadcasters, buffer_size, buffer_policy):
+        _PushHandler.initialize(self, supported_agencies, event_index, clock, broadcasters, buffer_size,
+                                buffer_policy)
+
     def check_origin(self, origin):
         # CORS header don't have any effect with WebSockets
         return True
 
+    def get_compression_options(self):
+        # Enables permessage-deflate when the client offers it
+        return {}
+
+    def select_subprotocol(self, subprotocols):
+        # The format can be negotiated as subprotocol, for example "msgpack"
+        for protocol in subprotocols:
+            if protocol in FORMATS:
+                return protocol
+        return None
+
+    def open(self, agency):
+        self.agency = agency
+        if agency not in self.supported_agencies:
+            self.write_message(
+                {
+                    "error": "Unsupported agency: {0}".format(agency),
+                    "status": 404
+                }
+            )
+            self.close()
+            return
+        try:
+            self._negotiate(self.selected_subprotocol or self.get_query_argument("format", "json"), True)
+        except ValueError as e:
+            logger.warning("Invalid request: %s", e)
+            self.write_message(
+                {
+                    "error": str(e),
+                    "status": 400
+                }
+            )
+            self.close()
+            return
+        tornado.ioloop.IOLoop.current().spawn_callback(self._write_loop)
+
     def on_message(self, message):
-        print("Message received: " + str(message))
-        print("Registering client, setting lastSyncTime")
+        logger.debug("Message received: %s, registering client, setting lastSyncTime", message)
         try:
-            self.last_event_timestamp = dateutil.parser.parse(message)
-            self.callback.start()
+            self._close()
+            self._subscribe(self.agency, dateutil.parser.parse(message))
         except ValueError as e:
-            print("Invalid datetime: {0}".format(e))
-            self._send(
+            logger.warning("Invalid datetime: %s", e)
+            self.write_message(
                 {
                     "error": "Invalid datetime: {0}".format(e),
                     "status": 400
@@ -281,55 +482,134 @@ class EventsHandlerWS(_PushHandler, tornado.websocket.WebSocketHandler):
 
     def on_close(self):
         self._close()
-
-    def _send(self, message):
-        try:
-            self.write_message(message)
-        except tornado.websocket.WebSocketClosedError:
-            print("WebSocket was already closed, cannot write data to it!")
-            self._close()
+        self.buffer.close()
+
+    async def _write_loop(self):
+        # Wait until every page is written to the socket before taking the next one from the buffer
+        while True:
+            message = await self.buffer.get()
+            if message is None:
+                break
+            body = self._encode(message)
+            try:
+                await self.write_message(body, binary=isinstance(body, bytes))
+            except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+                logger.warning("WebSocket was already closed, cannot write data to it!")
+                break
+        self._close()
+        self.close()
 
 
 class EventsHandlerNew(_BaseEventsHandler, tornado.web.RequestHandler):
-    def post(self, agency):
+    def initialize(self, supported_agencies, event_index, clock, event_log, event_bus):
+        _BaseEventsHandler.initialize(self, supported_agencies, event_index, clock)
+        self.event_log = event_log
+        self.event_bus = event_bus
+
+    async def post(self, agency):
         if agency in self.supported_agencies:
-            print("POST event received")
             timestamp = self.get_argument("timestamp")
             connection_uri = self.get_argument("connectionURI")
             action = self.get_argument("action")
-            print("TIMESTAMP=" + str(timestamp))
-            print("CONNECTION URI=" + str(connection_uri))
-            print("ACTION=" + str(action))
-            self._add_event(timestamp, connection_uri, action)
-            self.write({
-                "status": 200
-            })
+            logger.debug("POST event received: timestamp=%s, connection URI=%s, action=%s", timestamp,
+                         connection_uri, action)
+            await self._add_events([self._create_event(timestamp, connection_uri, action)])
         else:
             self.set_status(404)
-            self.store.submit(
+            self.write(
                 {
                     "error": "Unsupported agency: {0}".format(agency),
                     "status": 404
                 }
             )
 
-    def _add_event(self, timestamp, connection_uri, action):
-        print("Adding event")
-        try:
-            # Open the events file
-            with open(EVENTS_FILE, "r") as json_file:
-                events = json.load(json_file)
-
-            # Create the event and add it to graph
-            e = {
-                "timestamp": timestamp,
-                "connectionURI": connection_uri
+    def _create_event(self, timestamp, connection_uri, action):
+        return {
+            "@id": connection_uri + "#" + timestamp,
+            "@type": "Event",
+            "sosa:resultTime": timestamp,
+            "sosa:hasResult": {
+                "@type": "sosa:hasResult",
+                "Connection": {
+                    "@id": connection_uri,
+                    "@type": "CanceledConnection" if action == "cancel" else "Connection"
+                }
             }
-            events.append(e)
-            events = sorted(events, key=lambda k: k["timestamp"])
-
-            # Save all events to the events file
-            with open(EVENTS_FILE, "w") as json_file:
-                json.dump(events, json_file)
-        except Exception as e:
-            print("Adding event FAILED: {0}".format(e))
+        }
+
+    async def _add_events(self, events):
+        logger.debug("Adding %d events", len(events))
+        try:
+            # The whole batch is rejected when a single event is invalid, before anything is indexed or logged
+            if len(events) == 0:
+                raise ValueError("No events")
+            for e in events:
+                validate_event(e)
+            datagrams = self.event_bus.datagrams(events) if self.event_bus is not None else []
+            # Events are visible right away, the response waits until they are written to the log
+            if len(events) == 1:
+                self.event_index.add(events[0])
+            else:
+                self.event_index.extend(events)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Adding events FAILED: %s", e)
+            self.set_status(400)
+            self.write(
+                {
+                    "error": "Invalid event: {0}".format(e),
+                    "status": 400
+                }
+            )
+            return
+
+        # Other workers add the events to their index as well, queued until they can take them
+        if self.event_bus is not None:
+            self.event_bus.publish(datagrams)
+
+        try:
+            await self.event_log.append(events)
+        except OSError as e:
+            logger.error("Adding events FAILED: %s", e)
+            self.set_status(500)
+            self.write(
+                {
+                    "error": "Events could not be saved: {0}".format(e),
+                    "status": 500
+                }
+            )
+            return
+
+        self.write({
+            "status": 200,
+            "events": len(events)
+        })
+
+
+class EventsHandlerBulk(EventsHandlerNew):
+    async def post(self, agency):
+        if agency in self.supported_agencies:
+            # The body is either a JSON array of events or one event per line (JSON Lines)
+            try:
+                body = self.request.body.decode("utf-8").strip()
+                if body.startswith("["):
+                    events = json.loads(body)
+                else:
+                    events = [json.loads(line) for line in body.splitlines() if line.strip()]
+            except ValueError as e:
+                self.set_status(400)
+                self.write(
+                    {
+                        "error": "Invalid events body: {0}".format(e),
+                        "status": 400
+                    }
+                )
+                return
+            await self._add_events(events)
+        else:
+            self.set_status(404)
+            self.write(
+                {
+                    "error": "Unsupported agency: {0}".format(agency),
+                    "status": 404
+                }
+            )
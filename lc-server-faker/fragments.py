@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import bisect
+import dateutil.parser
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import urlencode
+from helpers import seconds_of_day
+from model import MISSING, ConnectionTable, Fragment, UriTable, parse_time
+
+logger = logging.getLogger(__name__)
+
+
+def link_filters(fragment, filters):
+    # The links of a filtered page keep the filters
+    query = urlencode(sorted(filters.items()))
+    for key in ["@id", "hydra:next", "hydra:previous"]:
+        if key in fragment:
+            fragment[key] += "&" + query
+
+
+class FragmentStore(object):
+    def __init__(self, directory="connections", dataset=None):
+        self.directory = directory
+        self.dataset = dataset
+        self.keys = []
+        self.paths = []
+        self.fragments = []
+        self.versions = []
+        self.digests = []
+        self.patched = set()
+        # The pages as they were before their first patch, for the days which do not follow the events
+        self.originals = {}
+        self.locations = None
+        # Shared by all fragments: URIs are interned once and identical contexts are kept once
+        self.uris = UriTable()
+        self.contexts = []
+        self.load()
+
+    def load(self):
+        # A shared dataset is already indexed, only the mapping is used
+        if self.dataset is not None:
+            self.keys = list(self.dataset.keys)
+            self.paths = list(self.dataset.names)
+            self.fragments = [None] * len(self.paths)
+            self.versions = [0] * len(self.paths)
+            self.digests = [None] * len(self.paths)
+            for uri in self.dataset.uris:
+                self.uris.intern(uri)
+            logger.info("Mapped %d fragments", len(self.paths))
+            return
+
+        # Index every fragment once by the time of day it starts, the date is ignored when serving
+        fragments = []
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if os.path.isfile(path) and path.endswith(".jsonld"):
+                start = dateutil.parser.parse(os.path.basename(os.path.splitext(path)[0]))
+                fragments.append((seconds_of_day(start), path))
+        fragments.sort()
+        self.keys = [k for k, _ in fragments]
+        self.paths = [p for _, p in fragments]
+        self.fragments = [None] * len(self.paths)
+        self.versions = [0] * len(self.paths)
+        self.digests = [None] * len(self.paths)
+        logger.info("Indexed %d fragments", len(self.paths))
+
+    def reset(self):
+        # Drop all patches, the pages are read from disk again
+        for index in range(0, len(self.fragments)):
+            if self.fragments[index] is not None:
+                self.fragments[index] = None
+                self.versions[index] += 1
+        self.patched = set()
+        self.originals = {}
+        self.locations = None
+
+    def find(self, departure):
+        # Last fragment starting at or before the requested time, clamped to the available fragments
+        return self._find(seconds_of_day(departure))
+
+    def _find(self, target):
+        index = bisect.bisect_right(self.keys, target) - 1
+        return min(max(index, 0), len(self.keys) - 1)
+
+    def original(self, index):
+        # The page as it was stored, without patches
+        if self.dataset is not None:
+            return self.dataset.fragment(index)
+        with open(self.paths[index], "rb") as json_file:
+            return json_file.read()
+
+    def digest(self, index):
+        if self.digests[index] is None:
+            self.digests[index] = hashlib.blake2b(self.original(index), digest_size=8).hexdigest()
+        return self.digests[index]
+
+    def etag(self, index):
+        # Strong validator: digest of the original page and the number of times it changed since
+        return "{0}-{1}".format(self.digest(index), self.versions[index])
+
+    def table(self, index):
+        if self.fragments[index] is None:
+            if self.dataset is not None:
+                fragment = json.loads(bytes(self.dataset.fragment(index)).decode("utf-8"))
+            else:
+                with open(self.paths[index], "r") as json_file:
+                    fragment = json.load(json_file)
+            graph = fragment.pop("@graph")
+            if "@context" in fragment:
+                fragment["@context"] = self._context(fragment["@context"])
+            self.fragments[index] = Fragment(fragment, ConnectionTable(self.uris, graph))
+        return self.fragments[index].table
+
+    def fragment(self, index):
+        # The JSON-LD representation is rendered from the compact table
+        self.table(index)
+        return self.fragments[index].to_jsonld()
+
+    def body(self, index):
+        # Unpatched fragments of a packed dataset are already serialized, they are served from the mapping
+        if self.dataset is not None and index not in self.patched:
+            return self.dataset.fragment(index)
+        return json.dumps(self.fragment(index)).encode("utf-8")
+
+    def filtered_body(self, index, filters, original=False):
+        # Only the matching rows are rendered, found through the inverted indexes of the page
+        self.table(index)
+        page = self.originals.get(index, self.fragments[index]) if original else self.fragments[index]
+        codes = {page.table.INDEXED[name]: self.uris.lookup(uri) for name, uri in filters.items()}
+        rows = page.table.select(codes) if MISSING not in codes.values() else []
+        fragment = page.to_jsonld(rows)
+        link_filters(fragment, filters)
+        return json.dumps(fragment).encode("utf-8")
+
+    def patch(self, connections):
+        # Copy-on-write: the touched pages are copied and patched, then all of them are swapped in at once
+        if self.locations is None:
+            self.locations = {}
+            if self.dataset is None:
+                for index in range(0, len(self.paths)):
+                    for connection_id in self.table(index).ids:
+                        self.locations[connection_id] = index
+
+        pages = {}
+        for c in connections:
+            index = self._locate(c["@id"])
+            if index is None:
+                continue
+            table = self._page(pages, index)
+            position = table.position(c["@id"])
+            updated = table.render(position)
+            updated.update(c)
+
+            # Keep the pages sorted, move the connection when its departureTime (including delay) belongs
+            # to another page
+            table.delete(position)
+            departure_time = parse_time(updated["departureTime"])
+            target = self._find(departure_time % (24 * 3600))
+            target_table = self._page(pages, target)
+            target_table.insert(bisect.bisect_right(target_table.departure_times, departure_time), updated)
+            self.locations[c["@id"]] = target
+
+        touched = []
+        for index, fragment in pages.items():
+            if index not in self.patched:
+                self.originals[index] = self.fragments[index]
+            touched.append((index, self.versions[index]))
+            self.fragments[index] = fragment
+            self.versions[index] += 1
+            self.patched.add(index)
+        return touched
+
+    def _locate(self, connection_id):
+        index = self.locations.get(connection_id)
+        if index is None and self.dataset is not None:
+            # The shared location index is keyed on a hash, the fragment itself confirms the match
+            for candidate in self.dataset.locate(connection_id):
+                if connection_id in self.table(candidate).ids:
+                    index = candidate
+                    self.locations[connection_id] = index
+                    break
+        return index
+
+    def _page(self, pages, index):
+        if index not in pages:
+            self.table(index)
+            pages[index] = self.fragments[index].copy()
+        return pages[index].table
+
+    def _context(self, context):
+        for c in self.contexts:
+            if c == context:
+                return c
+        self.contexts.append(context)
+        return context
+
+    def __len__(self):
+        return len(self.paths)
@@ -1,143 +1,295 @@
 #!/usr/bin/python3
 
+import asyncio
+import concurrent.futures
 import dateutil.parser
-import datetime
+import functools
+import logging
+import re
 import requests
+import requests.adapters
 import json
+import multiprocessing
+import numpy
 import os
-import random
 from urllib.parse import urlparse, parse_qs
 from constants import *
 
+logger = logging.getLogger(__name__)
 
-def fetch_connections(server_url):
+HYDRA_NEXT = re.compile(rb'"hydra:next"\s*:\s*"([^"]+)"')
+# Kept in the directory until the download is complete, with the time window which is downloaded
+FETCH_STATE = ".fetch.json"
+EVENT_TEMPLATE = '{{"@id": {id_prefix}#{generated_at_time}.000Z", "@type": "Event", ' \
+                 '"hydra:view": "http://localhost:8080/sncb/connections?departureTime={departure_time}.000Z", ' \
+                 '"sosa:resultTime": "{generated_at_time}.000Z", "sosa:hasResult": {{"@type": "sosa:hasResult", ' \
+                 '"Connection": {{"@id": {connection_id}, "@type": "{connection_type}", {stops}, ' \
+                 '"departureTime": "{departure_time}.000Z", "arrivalTime": "{arrival_time}.000Z", {static}}}}}' \
+                 '{extra}}}'
+
+
+def seconds_of_day(date):
+    return date.hour * 3600 + date.minute * 60 + date.second
+
+
+def fetch_connections(server_url, directory="connections", source_url=SOURCE_URL, start_time=START_TIME,
+                      stop_time=STOP_TIME, ranges=FETCH_RANGES, concurrency=FETCH_CONCURRENCY, retries=FETCH_RETRIES):
+    # An existing directory holds the dataset, only an unfinished download of it is resumed, for the same days
+    state_path = os.path.join(directory, FETCH_STATE)
+    if os.path.exists(directory):
+        if not os.path.exists(state_path):
+            return True
+        with open(state_path, "r") as json_file:
+            state = json.load(json_file)
+        start_time, stop_time = state["start"], state["stop"]
+        logger.info("Resuming the download from %s until %s", start_time, stop_time)
+    else:
+        os.mkdir(directory)
+        with open(state_path, "w") as json_file:
+            json.dump({"start": start_time, "stop": stop_time}, json_file)
+
+    # The dataset is split in independent time ranges which are downloaded concurrently
+    start = dateutil.parser.parse(start_time).replace(tzinfo=None)
+    stop = dateutil.parser.parse(stop_time).replace(tzinfo=None)
+    step = (stop - start) / ranges
+    bounds = [(start + i * step, start + (i + 1) * step) for i in range(0, ranges)]
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * concurrency)
+    loop = asyncio.new_event_loop()
     try:
-        url = FRAGMENT_URL
-        if not os.path.exists("connections"):
-            os.mkdir("connections")
+        failures = loop.run_until_complete(_fetch_ranges(session, executor, bounds, server_url, directory,
+                                                         source_url, concurrency, retries))
+    finally:
+        loop.close()
+        executor.shutdown()
+        session.close()
+
+    # Everything which was saved is kept, the next run resumes from the last saved fragments
+    for (range_start, range_end), e in failures:
+        logger.error("Generating connections FAILED between %s and %s: %s", range_start, range_end, e)
+    if len(failures) > 0:
+        return False
+    os.remove(state_path)
+    return True
+
+
+async def _fetch_ranges(session, executor, bounds, server_url, directory, source_url, concurrency, retries):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_range(range_start, range_end):
+        async with semaphore:
+            try:
+                await _fetch_range(session, executor, range_start, range_end, server_url, directory,
+                                   source_url, retries)
+            except Exception as e:
+                return (range_start, range_end), e
+
+    results = await asyncio.gather(*[fetch_range(range_start, range_end) for range_start, range_end in bounds])
+    return [r for r in results if r is not None]
+
+
+async def _fetch_range(session, executor, range_start, range_end, server_url, directory, source_url, retries):
+    loop = asyncio.get_event_loop()
+    url = _resume_url(directory, range_start, range_end, server_url, source_url)
+    save = None
+    while url is not None:
+        logger.debug("Downloading: %s", url)
+        body = await _download(loop, session, executor, url, retries)
+
+        # Find the next fragment without decoding the whole page, so the next download can start right away
+        match = HYDRA_NEXT.search(body)
+        if match is None:
+            raise ValueError("Fragment without hydra:next: {0}".format(url))
+        url = match.group(1).decode("utf-8")
+        if _departure_time(url) >= range_end:
+            url = None
+
+        # Parsing, fixing the hydra navigation and saving overlap with the next download
+        if save is not None:
+            await save
+        save = loop.run_in_executor(executor, _save_fragment, body, directory, server_url, source_url)
+    if save is not None:
+        await save
+
+
+async def _download(loop, session, executor, url, retries):
+    attempt = 0
+    while True:
+        try:
+            response = await loop.run_in_executor(executor, functools.partial(session.get, url, timeout=60))
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning("Downloading %s FAILED, retrying (%d/%d): %s", url, attempt, retries, e)
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+def _resume_url(directory, range_start, range_end, server_url, source_url):
+    url = FRAGMENT_URL.format(source_url, range_start.isoformat() + ".000Z")
+    saved = {}
+    for f in os.listdir(directory):
+        if f.endswith(".jsonld"):
+            saved[dateutil.parser.parse(os.path.splitext(f)[0]).replace(tzinfo=None)] = f
 
-            while True:
-                print("Downloading: " + url)
-                fragment = requests.get(url).json()
+    # Follow the saved chain from the page which covers the start of the range up to the first missing page
+    before = [d for d in saved if d <= range_start]
+    if len(before) == 0:
+        return url
+    f = saved[max(before)]
+    first = True
+    while True:
+        with open(os.path.join(directory, f), "rb") as json_file:
+            match = HYDRA_NEXT.search(json_file.read())
+        if match is None:
+            return url
+        next_url = match.group(1).decode("utf-8").replace(server_url, source_url)
+        next_date = _departure_time(next_url)
+        if first and next_date <= range_start:
+            return url
+        if next_date >= range_end:
+            return None
+        f = saved.get(next_date)
+        if f is None:
+            return next_url
+        first = False
 
-                # Find next fragment
-                url = fragment["hydra:next"]
-                departure_time_query = parse_qs(urlparse(url).query)["departureTime"][0]
-                date = dateutil.parser.parse(departure_time_query)
 
-                # Fix hydra navigation
-                fragment["hydra:next"] = fragment["hydra:next"].replace("https://graph.irail.be",
-                                                                        server_url)
-                fragment["hydra:previous"] = fragment["hydra:previous"].replace("https://graph.irail.be",
-                                                                        server_url)
+def _save_fragment(body, directory, server_url, source_url):
+    fragment = json.loads(body.decode("utf-8"))
 
-                # Save fragment
-                departure_time_query = parse_qs(urlparse(fragment['@id']).query)["departureTime"][0]
-                with open("connections/" + departure_time_query + ".jsonld", "w") as json_file:
-                    json.dump(fragment, json_file)
+    # Fix hydra navigation
+    fragment["hydra:next"] = fragment["hydra:next"].replace(source_url, server_url)
+    fragment["hydra:previous"] = fragment["hydra:previous"].replace(source_url, server_url)
 
-                if date >= dateutil.parser.parse(STOP_TIME):
-                    break
-    except Exception as e:
-        print("Generating connections FAILED: {0}".format(e))
-        os.rmdir("connections")
+    # Save fragment, a partially written file is never picked up when resuming
+    departure_time_query = parse_qs(urlparse(fragment["@id"]).query)["departureTime"][0]
+    path = os.path.join(directory, departure_time_query + ".jsonld")
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(fragment, json_file)
+    os.replace(path + ".tmp", path)
+
+
+def _departure_time(url):
+    return dateutil.parser.parse(parse_qs(urlparse(url).query)["departureTime"][0]).replace(tzinfo=None)
 
 
 def generate_pseudorandom_events(number_of_events, additional_event_time, max_delay,
-                                 max_additional_delay, step_delay):
-    try:
-        if not os.path.exists("events"):
-            os.mkdir("events")
-            # Find all connections files
-            files = []
-            for f in os.listdir("connections"):
-                path = os.path.join("connections", f)
-                if os.path.isfile(path):
-                    files.append(path)
-            files.sort()
-
-            # Generate a random number of events for each file
-            events = []
-            for f in files:
-                with open(f, "r") as json_file:
-                    data = json.load(json_file)
-
-                number_of_events = random.randint(1, int(len(data["@graph"]) * 0.10)) # 10% of the connections
-                print("Generating {} events from: {}".format(number_of_events, f))
-                for i in range(0, number_of_events):
-                    connection = random.choice(data["@graph"])
-
-                    # Generate random generated_at_time in the further and adjust the delays
-                    generated_at_time = dateutil.parser.parse(connection["departureTime"]) \
-                                + datetime.timedelta(minutes=random.randint(0, additional_event_time))
-
-                    # Ignore events that are outside our 24h window
-                    if generated_at_time >= dateutil.parser.parse(STOP_TIME):
-                        continue
-
-                    # Randomly cancel some connections
-                    connection_type = "Connection"
-                    if random.random() > 0.99:
-                        connection_type = "CanceledConnection"
-                        departure_time = dateutil.parser.parse(connection["departureTime"])
-                        arrival_time = dateutil.parser.parse(connection["arrivalTime"])
-                    # If not canceled, calculate arrival and departure time with delays, max 1 hour departure delay
-                    else:
-                        departure_delay = random.randrange(0, max_delay, step_delay)
-                        if random.random() >= 0.5:
-                            arrival_delay = departure_delay + random.randrange(0, max_additional_delay, step_delay)
-                        else:
-                            arrival_delay = departure_delay - random.randrange(0, 3*60, 60)
-                        departure_time = dateutil.parser.parse(connection["departureTime"])\
-                                + datetime.timedelta(seconds=departure_delay)
-                        arrival_time = dateutil.parser.parse(connection["arrivalTime"])\
-                                + datetime.timedelta(seconds=arrival_delay)
-
-                    # Convert to ISO format
-                    generated_at_time = generated_at_time.replace(tzinfo=None).isoformat() + ".000Z"
-                    departure_time = departure_time.replace(tzinfo=None).isoformat() + ".000Z"
-                    arrival_time = arrival_time.replace(tzinfo=None).isoformat() + ".000Z"
-
-                    # Create an event object
-                    e = {
-                        "@id": connection["@id"] + "#" + generated_at_time,
-                        "@type": "Event",
-                        "hydra:view": "http://localhost:8080/sncb/connections?departureTime=" + departure_time,
-                        "sosa:resultTime": generated_at_time,
-                        "sosa:hasResult": {
-                            "@type": "sosa:hasResult",
-                            "Connection": {
-                                "@id": connection["@id"],
-                                "@type": connection_type,
-                                "departureStop": connection["departureStop"],
-                                "arrivalStop": connection["arrivalStop"],
-                                "departureTime": departure_time,
-                                "arrivalTime": arrival_time,
-                                "direction": connection["direction"],
-                                "gtfs:trip": connection["gtfs:trip"],
-                                "gtfs:route": connection["gtfs:route"],
-                            }
-                        }
-                    }
-
-                    # Some properties aren't always available
-                    if "departureDelay" in connection:
-                        e["departureDelay"] = departure_delay
-
-                    if "arrivalDelay" in connection:
-                        e["arrivalDelay"] = arrival_delay
-
-                    if "gtfs:pickupType" in connection:
-                        e["gtfs:pickupType"] = connection["gtfs:pickupType"]
-
-                    if "gtfs:dropOffType" in connection:
-                        e["gtfs:dropOffType"] = connection["gtfs:dropOffType"]
-                    events.append(e)
-
-            # Save all events for this file
-            with open(EVENTS_FILE, "w") as json_file:
-                json.dump(events, json_file)
-    except Exception as e:
-        raise e
-        #print("Generating pseudorandom events FAILED: {0}".format(e))
-        #os.rmdir("events")
+                                 max_additional_delay, step_delay, seed=None, processes=None,
+                                 directory="connections", path=EVENTS_FILE):
+    if os.path.exists(os.path.dirname(path)):
+        return
+    os.mkdir(os.path.dirname(path))
+
+    # Find all connections files
+    files = []
+    for f in os.listdir(directory):
+        f = os.path.join(directory, f)
+        if os.path.isfile(f) and f.endswith(".jsonld"):
+            files.append(f)
+    files.sort()
+
+    # Every file gets its own child seed, the output only depends on the seed and not on the scheduling
+    seeds = numpy.random.SeedSequence(seed).spawn(len(files))
+    tasks = [(f, s, number_of_events, additional_event_time, max_delay, max_additional_delay, step_delay)
+             for f, s in zip(files, seeds)]
+
+    # Stream the events of each file to disk as soon as the pool returns them
+    count = 0
+    with multiprocessing.Pool(processes) as pool, open(path, "w") as json_file:
+        json_file.write("[")
+        for lines in pool.imap(_generate_fragment_events, tasks):
+            if len(lines) == 0:
+                continue
+            json_file.write((", " if count > 0 else "") + ", ".join(lines))
+            count += len(lines)
+        json_file.write("]")
+    logger.info("Generated %d events from %d files", count, len(files))
+
+
+def _generate_fragment_events(task):
+    f, seed, number_of_events, additional_event_time, max_delay, max_additional_delay, step_delay = task
+    rng = numpy.random.default_rng(seed)
+    with open(f, "r") as json_file:
+        graph = json.load(json_file)["@graph"]
+    if len(graph) == 0:
+        return []
+
+    # Parse the connection times once, all draws are done in batches
+    departure_times = numpy.array([c["departureTime"][:19] for c in graph], dtype="datetime64[s]")
+    arrival_times = numpy.array([c["arrivalTime"][:19] for c in graph], dtype="datetime64[s]")
+    connections = rng.integers(0, len(graph), number_of_events)
+
+    # Random generated_at_time in the future, ignore events that are outside our 24h window
+    generated_at_times = departure_times[connections] \
+        + rng.integers(0, additional_event_time + 1, number_of_events) * numpy.timedelta64(60, "s")
+    keep = generated_at_times < numpy.datetime64(STOP_TIME[:19])
+    connections = connections[keep]
+    generated_at_times = generated_at_times[keep]
+    n = len(connections)
+
+    # Randomly cancel some connections, the others get a departure delay and a larger or smaller arrival delay
+    canceled = rng.random(n) > 0.99
+    departure_delays = rng.integers(0, -(-max_delay // step_delay), n) * step_delay
+    arrival_delays = numpy.where(rng.random(n) >= 0.5,
+                                 departure_delays + rng.integers(0, -(-max_additional_delay // step_delay), n)
+                                 * step_delay,
+                                 departure_delays - rng.integers(0, 3, n) * 60)
+    departure_delays[canceled] = 0
+    arrival_delays[canceled] = 0
+
+    # Convert to ISO format, plain Python lists are much faster to format than NumPy scalars
+    generated_at_times = numpy.datetime_as_string(generated_at_times, unit="s").tolist()
+    departure_times = numpy.datetime_as_string(departure_times[connections]
+                                               + departure_delays * numpy.timedelta64(1, "s"), unit="s").tolist()
+    arrival_times = numpy.datetime_as_string(arrival_times[connections]
+                                             + arrival_delays * numpy.timedelta64(1, "s"), unit="s").tolist()
+    connections = connections.tolist()
+    canceled = canceled.tolist()
+    departure_delays = departure_delays.tolist()
+    arrival_delays = arrival_delays.tolist()
+
+    # Serialize the parts of a connection once, events are formatted from these strings
+    parts = {}
+    lines = []
+    for i in range(0, n):
+        c = connections[i]
+        if c not in parts:
+            parts[c] = _event_parts(graph[c])
+        connection_id, stops, static, departure_delay, arrival_delay, extra = parts[c]
+
+        # Some properties aren't always available
+        delays = ""
+        if departure_delay:
+            delays += ", \"departureDelay\": {0}".format(departure_delays[i])
+        if arrival_delay:
+            delays += ", \"arrivalDelay\": {0}".format(arrival_delays[i])
+
+        lines.append(EVENT_TEMPLATE.format(id_prefix=connection_id[:-1],
+                                           connection_id=connection_id,
+                                           generated_at_time=generated_at_times[i],
+                                           departure_time=departure_times[i],
+                                           arrival_time=arrival_times[i],
+                                           connection_type="CanceledConnection" if canceled[i] else "Connection",
+                                           stops=stops,
+                                           static=static,
+                                           extra=delays + extra))
+    return lines
+
+
+def _event_parts(connection):
+    def members(keys):
+        return ", ".join("{0}: {1}".format(json.dumps(k), json.dumps(connection[k])) for k in keys)
+
+    return (json.dumps(connection["@id"]),
+            members(("departureStop", "arrivalStop")),
+            members(("direction", "gtfs:trip", "gtfs:route")),
+            "departureDelay" in connection,
+            "arrivalDelay" in connection,
+            "".join(", " + members((k,)) for k in ("gtfs:pickupType", "gtfs:dropOffType") if k in connection))
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+import bisect
+import logging
+import logging.handlers
+import queue
+import sys
+import tornado.ioloop
+import tornado.web
+
+# Histogram buckets (seconds)
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+LOOP_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+LOOP_INTERVAL = 0.1
+
+access_logger = logging.getLogger("access")
+_listener = None
+
+
+def setup_logging(level):
+    # Handlers only put records on a queue, a background thread does the actual writing
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    records = queue.Queue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _listener = logging.handlers.QueueListener(records, stream_handler)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    # Requests are logged by log_request()
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+    _listener.start()
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _format_labels(names, values, extra=()):
+    labels = list(zip(names, values)) + list(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Histogram(object):
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Label values: [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = [[0] * len(self.buckets), 0.0, 0]
+            self.series[labels] = series
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            series[0][position] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.description), "# TYPE {0} histogram".format(self.name)]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append("{0}_bucket{1} {2}".format(self.name, _format_labels(self.labels, labels,
+                                                                                  [("le", bound)]), cumulative))
+            lines.append("{0}_bucket{1} {2}".format(self.name, _format_labels(self.labels, labels, [("le", "+Inf")]),
+                                                    count))
+            lines.append("{0}_sum{1} {2}".format(self.name, _format_labels(self.labels, labels), total))
+            lines.append("{0}_count{1} {2}".format(self.name, _format_labels(self.labels, labels), count))
+        return lines
+
+
+class Collector(object):
+    # Counters and gauges which are owned by other objects are read when they are scraped
+    def __init__(self, name, kind, description, collect, labels=()):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.collect = collect
+        self.labels = labels
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.description), "# TYPE {0} {1}".format(self.name, self.kind)]
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append("{0}{1} {2}".format(self.name, _format_labels(self.labels, labels), value))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, description, labels, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def counter(self, name, description, collect, labels=()):
+        self.metrics.append(Collector(name, "counter", description, collect, labels))
+
+    def gauge(self, name, description, collect, labels=()):
+        self.metrics.append(Collector(name, "gauge", description, collect, labels))
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_LATENCY = REGISTRY.histogram("lc_http_request_duration_seconds", "Time to answer a request.",
+                                     ("handler", "method", "code"))
+FANOUT_LAG = REGISTRY.histogram("lc_event_fanout_lag_seconds",
+                                "Time between the result time of an event and pushing it to all subscribers.")
+LOOP_BLOCKING = REGISTRY.histogram("lc_ioloop_blocking_seconds",
+                                   "Delay of a periodic IOLoop callback, the time the loop was blocked.",
+                                   buckets=LOOP_BUCKETS)
+
+
+def log_request(handler):
+    # Replaces the access log of Tornado: every request is measured, only logged at debug level
+    duration = handler.request.request_time()
+    REQUEST_LATENCY.observe(duration, type(handler).__name__, handler.request.method, handler.get_status())
+    if access_logger.isEnabledFor(logging.DEBUG):
+        access_logger.debug("%d %s %s %.2fms", handler.get_status(), handler.request.method, handler.request.uri,
+                            1000 * duration)
+
+
+class LoopMonitor(object):
+    def __init__(self, interval=LOOP_INTERVAL):
+        self.interval = interval
+        self.expected = None
+        self.timeout = None
+
+    def start(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        self.expected = io_loop.time() + self.interval
+        self.timeout = io_loop.call_at(self.expected, self._check)
+
+    def stop(self):
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _check(self):
+        # A callback can only run late when something else held the loop
+        LOOP_BLOCKING.observe(max(tornado.ioloop.IOLoop.current().time() - self.expected, 0.0))
+        self.start()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.registry.render())
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import logging
+import os
+import socket
+import tornado.ioloop
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 64 * 1024
+RETRY_INTERVAL = 0.1
+
+
+class EventBus(object):
+    def __init__(self, directory, worker, workers, event_index):
+        # One datagram socket per worker, new events are sent to all the other workers
+        self.event_index = event_index
+        self.path = os.path.join(directory, "{0}.sock".format(worker))
+        self.peers = [os.path.join(directory, "{0}.sock".format(i)) for i in range(0, workers) if i != worker]
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.receiver.bind(self.path)
+        self.receiver.setblocking(False)
+        self.senders = [_Peer(peer) for peer in self.peers]
+        tornado.ioloop.IOLoop.current().add_handler(self.receiver.fileno(), self._receive,
+                                                    tornado.ioloop.IOLoop.READ)
+
+    def publish(self, datagrams):
+        # Never block the IOLoop on a full peer, the datagrams wait in the queue of that peer instead
+        for sender in self.senders:
+            sender.pending.extend(datagrams)
+            self._flush(sender)
+
+    def pending(self):
+        return sum(len(sender.pending) for sender in self.senders)
+
+    def _flush(self, sender):
+        if sender.waiting:
+            return
+        while len(sender.pending) > 0:
+            try:
+                if sender.socket is None:
+                    sender.connect()
+                sender.socket.send(sender.pending[0])
+            except BlockingIOError:
+                # The other worker did not read its queue yet, continue once there is room again
+                sender.waiting = True
+                tornado.ioloop.IOLoop.current().add_handler(sender.socket.fileno(),
+                                                            lambda fd, events: self._writable(sender),
+                                                            tornado.ioloop.IOLoop.WRITE)
+                return
+            except OSError as e:
+                # The worker is not listening (yet), keep the events and try again later
+                if not sender.failing:
+                    logger.warning("Publishing events to %s FAILED, retrying: %s", sender.path, e)
+                sender.failing = True
+                sender.disconnect()
+                sender.waiting = True
+                sender.timeout = tornado.ioloop.IOLoop.current().call_later(RETRY_INTERVAL, self._retry, sender)
+                return
+            sender.pending.popleft()
+            if sender.failing:
+                logger.info("Publishing events to %s recovered", sender.path)
+                sender.failing = False
+
+    def _writable(self, sender):
+        tornado.ioloop.IOLoop.current().remove_handler(sender.socket.fileno())
+        sender.waiting = False
+        self._flush(sender)
+
+    def _retry(self, sender):
+        sender.timeout = None
+        sender.waiting = False
+        self._flush(sender)
+
+    def datagrams(self, events):
+        # Split the batch so every datagram stays below the size limit, an event which does not fit on its own
+        # cannot be sent to the other workers
+        datagrams = []
+        datagram = []
+        size = 2
+        for e in events:
+            line = json.dumps(e).encode("utf-8")
+            if len(line) + 2 > MAX_DATAGRAM:
+                raise ValueError("Event larger than {0} bytes".format(MAX_DATAGRAM - 2))
+            if len(datagram) > 0 and size + len(line) + 2 > MAX_DATAGRAM:
+                datagrams.append(b"[" + b", ".join(datagram) + b"]")
+                datagram = []
+                size = 2
+            datagram.append(line)
+            size += len(line) + 2
+        if len(datagram) > 0:
+            datagrams.append(b"[" + b", ".join(datagram) + b"]")
+        return datagrams
+
+    def _receive(self, fd, events):
+        while True:
+            try:
+                datagram, _, flags, _ = self.receiver.recvmsg(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            if flags & socket.MSG_TRUNC:
+                logger.error("Received a truncated datagram of events, dropping it")
+                continue
+            received = json.loads(datagram.decode("utf-8"))
+            if len(received) == 1:
+                self.event_index.add(received[0])
+            else:
+                self.event_index.extend(received)
+
+    def close(self):
+        tornado.ioloop.IOLoop.current().remove_handler(self.receiver.fileno())
+        self.receiver.close()
+        for sender in self.senders:
+            if sender.pending:
+                logger.warning("Dropping %d datagrams of events for %s", len(sender.pending), sender.path)
+            sender.close()
+        # The parent removes the whole directory when it exits, possibly before the workers
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Peer(object):
+    def __init__(self, path):
+        # A connected socket per peer, so it only polls writable when that peer has room in its queue
+        self.path = path
+        self.socket = None
+        self.pending = collections.deque()
+        self.waiting = False
+        self.failing = False
+        self.timeout = None
+
+    def connect(self):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            sender.connect(self.path)
+        except OSError:
+            sender.close()
+            raise
+        self.socket = sender
+
+    def disconnect(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def close(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.timeout is not None:
+            io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+        if self.socket is not None and self.waiting:
+            io_loop.remove_handler(self.socket.fileno())
+        self.disconnect()
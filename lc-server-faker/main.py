@@ -3,13 +3,35 @@
 import argparse
 import os
 import datetime
+import dateutil.parser
 import helpers
+import logging
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import shutil
+import sys
+import tempfile
 from connections import ConnectionsHandler
 from constants import *
-from events import EventsHandlerHTTP, EventsHandlerSSE, EventsHandlerWS, EventsHandlerNew, EventsHandlerStatic
+from fragments import FragmentStore
+from cache import FragmentCache
+from eventindex import EventIndex, LatestState, log_files
+from eventlog import EventLog
+from broadcaster import EventBroadcaster
+from clock import Clock
+from dataset import SharedDataset, is_current, refresh_dataset
+from servicedays import ServiceCalendar, load_exceptions
+from backpressure import POLICIES, STATS
+from ipc import EventBus
+from instrumentation import REGISTRY, LoopMonitor, MetricsHandler, log_request, setup_logging, stop_logging
+from events import EventsHandlerHTTP, EventsHandlerSSE, EventsHandlerWS, EventsHandlerNew, EventsHandlerBulk, \
+    EventsHandlerStatic
+
+
+logger = logging.getLogger(__name__)
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -18,6 +40,54 @@ class MainHandler(tornado.web.RequestHandler):
         self.render("assets/index.html")
 
 
+def register_metrics(fragment_cache, event_index, event_log, event_bus, broadcasters, calendar):
+    REGISTRY.counter("lc_fragment_cache_hits_total", "Fragments served from the cache.",
+                     lambda: fragment_cache.hits)
+    REGISTRY.counter("lc_fragment_cache_misses_total", "Fragments which had to be serialized or compressed.",
+                     lambda: fragment_cache.misses)
+    REGISTRY.gauge("lc_fragment_cache_hit_ratio", "Fraction of the fragments served from the cache.",
+                   lambda: fragment_cache.hits / max(fragment_cache.hits + fragment_cache.misses, 1))
+    REGISTRY.gauge("lc_fragment_cache_entries", "Fragment versions in the cache.",
+                   lambda: len(fragment_cache.entries))
+    REGISTRY.gauge("lc_fragment_cache_bytes", "Size of the cached bodies.",
+                   lambda: fragment_cache.size)
+    if calendar is not None:
+        REGISTRY.counter("lc_calendar_materialized_total", "Calendar pages which had to be materialized.",
+                         lambda: calendar.materialized)
+    REGISTRY.gauge("lc_events", "Events in the index.",
+                   lambda: len(event_index))
+    REGISTRY.gauge("lc_event_log_queue_depth", "Batches waiting to be written to the event log.",
+                   lambda: event_log.queue.qsize())
+    if event_bus is not None:
+        REGISTRY.gauge("lc_ipc_queue_depth", "Datagrams of events waiting to be sent to the other workers.",
+                       lambda: event_bus.pending())
+
+    def subscribers():
+        counts = {}
+        for agency, broadcaster in broadcasters.items():
+            for s in broadcaster.cursors:
+                key = (agency, type(s).__name__)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def queue_depths(aggregate):
+        return {(agency,): aggregate([s.queue_depth() for s in broadcaster.cursors] or [0])
+                for agency, broadcaster in broadcasters.items()}
+
+    REGISTRY.gauge("lc_subscribers", "Connected push subscribers.", subscribers, ("agency", "handler"))
+    REGISTRY.gauge("lc_subscriber_queue_depth", "Messages waiting to be written to the push subscribers.",
+                   lambda: queue_depths(sum), ("agency",))
+    REGISTRY.counter("lc_subscriber_dropped_events_total", "Events which were dropped for slow push subscribers.",
+                     lambda: STATS["dropped"])
+    REGISTRY.counter("lc_subscriber_coalesced_events_total",
+                     "Events which were replaced by a later event of the same connection for slow push subscribers.",
+                     lambda: STATS["coalesced"])
+    REGISTRY.counter("lc_subscriber_disconnects_total", "Push subscribers which were disconnected for being too slow.",
+                     lambda: STATS["disconnected"])
+    REGISTRY.gauge("lc_subscriber_queue_depth_max", "Messages waiting for the slowest push subscriber.",
+                   lambda: queue_depths(max), ("agency",))
+
+
 def main():
     # Commandline configuration
     parser = argparse.ArgumentParser(
@@ -47,6 +117,71 @@ def main():
                         default=MAX_ADDITONAL_DELAY,
                         type=int,
                         help="Additional delay time which is added to the connection.")
+    parser.add_argument("-s", "--seed",
+                        default=None,
+                        type=int,
+                        help="Seed for the pseudorandom events, the same seed generates the same events.")
+    parser.add_argument("-fcs", "--fragmentcachesize",
+                        default=FRAGMENT_CACHE_SIZE,
+                        type=int,
+                        help="Memory budget (bytes) for serialized and compressed fragments.")
+    parser.add_argument("-fc", "--fetchconcurrency",
+                        default=FETCH_CONCURRENCY,
+                        type=int,
+                        help="Number of time ranges of the dataset which are downloaded concurrently.")
+    parser.add_argument("-fr", "--fetchretries",
+                        default=FETCH_RETRIES,
+                        type=int,
+                        help="Number of retries for a failed fragment download.")
+    parser.add_argument("-w", "--workers",
+                        default=WORKERS,
+                        type=int,
+                        help="Number of worker processes sharing the HTTP port and the dataset.")
+    parser.add_argument("-ps", "--pagesize",
+                        default=PAGE_SIZE,
+                        type=int,
+                        help="Repaginate the connections with this number of connections per page.")
+    parser.add_argument("-pw", "--pagewindow",
+                        default=PAGE_WINDOW,
+                        type=int,
+                        help="Repaginate the connections with pages covering this number of minutes.")
+    parser.add_argument("-eps", "--eventspagesize",
+                        default=EVENTS_PAGE_SIZE,
+                        type=int,
+                        help="Maximum number of events in a page of /events.")
+    parser.add_argument("-sb", "--subscriberbuffer",
+                        default=SUBSCRIBER_BUFFER,
+                        type=int,
+                        help="Maximum number of events waiting for a single push subscriber.")
+    parser.add_argument("-sbp", "--subscriberpolicy",
+                        default=SUBSCRIBER_POLICY,
+                        choices=POLICIES,
+                        help="What happens when a push subscriber falls further behind: drop the oldest events, "
+                             "keep the latest event of every connection, or disconnect it with a cursor to resume.")
+    parser.add_argument("-ci", "--checkpointinterval",
+                        default=LATEST_CHECKPOINT_INTERVAL,
+                        type=int,
+                        help="Seconds of result time between the checkpoints of the latest event of every connection, "
+                             "used by compact=true.")
+    parser.add_argument("-st", "--start",
+                        default=None,
+                        help="Start time (UTC) of the simulated clock, for example 06:00 or 2019-01-01T06:00:00Z.")
+    parser.add_argument("-sp", "--speed",
+                        default=SPEED,
+                        type=float,
+                        help="Speed of the simulated clock, 60 replays an hour of events in a minute.")
+    parser.add_argument("-wk", "--weeks",
+                        default=CALENDAR_WEEKS,
+                        type=int,
+                        help="Serve the connections on every date of this number of weeks, starting on the Monday "
+                             "of the current week, instead of ignoring the date.")
+    parser.add_argument("-ex", "--exceptions",
+                        default=None,
+                        help="JSON file with the routes without service per date, \"*\" for all of them.")
+    parser.add_argument("-l", "--loglevel",
+                        default=LOG_LEVEL,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Only log messages of this level or above, DEBUG logs every request.")
     parser.add_argument("-c", "--clean", action="store_true",
                         help="Clean up data and download a fresh dataset.")
     args = parser.parse_args()
@@ -56,60 +191,172 @@ def main():
     max_additional_delay = args.maxadditionaldelay
     step_delay = args.stepdelay
     additional_event_time = args.additionaleventtime
+    seed = args.seed
+    fragment_cache_size = args.fragmentcachesize
+    fetch_concurrency = args.fetchconcurrency
+    fetch_retries = args.fetchretries
+    workers = args.workers
+    log_level = args.loglevel
+    start = None
+    if args.start is not None:
+        start = dateutil.parser.parse(args.start)
+        if start.tzinfo is not None:
+            start = start.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    speed = args.speed
+    page_size = args.pagesize
+    page_window = args.pagewindow
+    events_page_size = args.eventspagesize
+    buffer_size = args.subscriberbuffer
+    buffer_policy = args.subscriberpolicy
+    checkpoint_interval = args.checkpointinterval
+    weeks = args.weeks
+    exceptions = load_exceptions(args.exceptions)
+    if page_size is not None and page_window is not None:
+        parser.error("--pagesize and --pagewindow cannot be combined")
+    setup_logging(log_level)
     if args.clean:
-        print("Removing old data...")
+        logger.info("Removing old data...")
         shutil.rmtree("connections")
         shutil.rmtree("events")
 
-    # Generate connections and events
-    helpers.fetch_connections("http://localhost:8080")
-    helpers.generate_pseudorandom_events(number_of_events, additional_event_time, max_delay,
-                                         max_additional_delay, step_delay)
+    # Generate connections and events, unless an up-to-date pack of them is left from the last run. An unfinished
+    # download is never packed, it is resumed first.
+    if not os.path.exists(os.path.join("connections", helpers.FETCH_STATE)) and \
+            is_current(DATASET_FILE, "connections", EVENTS_FILE, page_size, page_window):
+        logger.info("Reusing %s", DATASET_FILE)
+    else:
+        if not helpers.fetch_connections("http://localhost:8080", concurrency=fetch_concurrency,
+                                         retries=fetch_retries):
+            logger.error("Downloading the connections FAILED, start again to resume the download")
+            stop_logging()
+            sys.exit(1)
+        helpers.generate_pseudorandom_events(number_of_events, additional_event_time, max_delay,
+                                             max_additional_delay, step_delay, seed)
+
+    # Bind before forking, all workers accept on the same listening socket
+    sockets = tornado.netutil.bind_sockets(port, reuse_port=workers > 1)
+    fragment_cache = FragmentCache(fragment_cache_size)
+    event_bus = None
+    if workers > 1 and any(os.path.getsize(p) > 0 for p in log_files(EVENTS_LOG)):
+        # Fold old event logs before packing, the workers only log their own new events
+        event_log = EventLog(EventIndex())
+        event_log.start()
+        event_log.stop()
+
+    # Fragments and events are packed in a single file and memory-mapped instead of parsing every fragment
+    refresh_dataset(DATASET_FILE, "connections", EVENTS_FILE, page_size, page_window)
+
+    # Created before forking, so every worker follows the same simulated time
+    clock = Clock(start, speed)
+    if workers > 1:
+        ipc_directory = tempfile.mkdtemp()
+        try:
+            worker = tornado.process.fork_processes(workers)
+        except BaseException:
+            # Only the parent gets here, once the workers exited or on Ctrl+C
+            shutil.rmtree(ipc_directory, ignore_errors=True)
+            raise
+        # The thread writing the logs did not survive the fork
+        setup_logging(log_level)
+    dataset = SharedDataset(DATASET_FILE)
+    fragment_store = FragmentStore(dataset=dataset)
+    event_index = EventIndex(dataset=dataset)
+    if workers > 1:
+        # Every worker logs its own events and forwards them to the other workers
+        event_log = EventLog(event_index, path=os.path.splitext(EVENTS_LOG)[0] + ".{0}.jsonl".format(worker),
+                             compaction_threshold=None)
+        event_bus = EventBus(ipc_directory, worker, workers, event_index)
+    else:
+        event_log = EventLog(event_index)
+    event_log.start()
+    latest_state = LatestState(event_index, checkpoint_interval)
+    broadcasters = {agency: EventBroadcaster(event_index, clock, latest_state) for agency in SUPPORTED_AGENCIES}
+    calendar = None
+    if weeks is not None:
+        today = clock.now().date()
+        calendar = ServiceCalendar(fragment_store, today - datetime.timedelta(days=today.weekday()), weeks,
+                                   exceptions)
 
     # Start updater for static fragment by creating a handler for these static pages
-    EventsHandlerStatic()
+    EventsHandlerStatic(event_index, fragment_store, fragment_cache, clock).start()
+
+    # Expose the state of the caches, subscribers and queues on /metrics
+    register_metrics(fragment_cache, event_index, event_log, event_bus, broadcasters, calendar)
+    LoopMonitor().start()
 
     # Print configuration
-    print("=" * 80)
-    print("SERVER CONFIGURATION")
-    print("-" * 80)
-    print("HTTP port: {0}".format(port))
-    print("Number of events for each fragment: {0}".format(number_of_events))
-    print("Max delay (seconds): {0}".format(max_delay))
-    print("Step delay (seconds): {0}".format(step_delay))
-    print("Additional event time (minutes): {0}".format(additional_event_time))
-    print("=" * 80)
+    logger.info("=" * 80)
+    logger.info("SERVER CONFIGURATION")
+    logger.info("-" * 80)
+    logger.info("HTTP port: %d", port)
+    logger.info("Number of events for each fragment: %d", number_of_events)
+    logger.info("Max delay (seconds): %d", max_delay)
+    logger.info("Step delay (seconds): %d", step_delay)
+    logger.info("Additional event time (minutes): %d", additional_event_time)
+    logger.info("Seed: %s", seed)
+    logger.info("Fragment cache size (bytes): %d", fragment_cache_size)
+    logger.info("Workers: %d", workers)
+    logger.info("Page size (connections): %s", page_size)
+    logger.info("Page window (minutes): %s", page_window)
+    logger.info("Events page size: %d", events_page_size)
+    logger.info("Subscriber buffer: %d events, %s", buffer_size, buffer_policy)
+    logger.info("Checkpoint interval (seconds): %d", checkpoint_interval)
+    logger.info("Clock: %s, speed %sx", clock.start.isoformat(), speed)
+    if calendar is not None:
+        logger.info("Calendar: %s until %s, template %s, %d exceptions", calendar.first_date.isoformat(),
+                    calendar.end_date.isoformat(), calendar.template_date.isoformat(), len(exceptions))
+    logger.info("Log level: %s", log_level)
+    logger.info("=" * 80)
 
     # Configure the Tornado server and run it
     app = tornado.web.Application([
         tornado.web.url(r"/",
                         MainHandler),
+        tornado.web.url(r"/metrics",
+                        MetricsHandler,
+                        dict(registry=REGISTRY),
+                        name="metrics"),
         tornado.web.url(r"/([a-z]+)/connections",
                         ConnectionsHandler,
-                        dict(supported_agencies=SUPPORTED_AGENCIES),
+                        dict(supported_agencies=SUPPORTED_AGENCIES, fragment_store=fragment_store,
+                             fragment_cache=fragment_cache, clock=clock, calendar=calendar),
                         name="connections"),
         tornado.web.url(r"/([a-z]+)/events",
                         EventsHandlerHTTP,
-                        dict(supported_agencies=SUPPORTED_AGENCIES),
+                        dict(supported_agencies=SUPPORTED_AGENCIES, event_index=event_index, clock=clock,
+                             page_size=events_page_size, latest_state=latest_state),
                         name="events_polling"),
         tornado.web.url(r"/([a-z]+)/events/sse",
                         EventsHandlerSSE,
-                        dict(supported_agencies=SUPPORTED_AGENCIES),
+                        dict(supported_agencies=SUPPORTED_AGENCIES, event_index=event_index, clock=clock,
+                             broadcasters=broadcasters, buffer_size=buffer_size, buffer_policy=buffer_policy),
                         name="events_sse"),
         tornado.web.url(r"/([a-z]+)/events/ws",
                         EventsHandlerWS,
-                        dict(supported_agencies=SUPPORTED_AGENCIES),
+                        dict(supported_agencies=SUPPORTED_AGENCIES, event_index=event_index, clock=clock,
+                             broadcasters=broadcasters, buffer_size=buffer_size, buffer_policy=buffer_policy),
                         name="events_ws"),
         tornado.web.url(r"/([a-z]+)/events/new",
                         EventsHandlerNew,
-                        dict(supported_agencies=SUPPORTED_AGENCIES),
-                        name="events_new")
-    ])
-    app.listen(port)
+                        dict(supported_agencies=SUPPORTED_AGENCIES, event_index=event_index, clock=clock,
+                             event_log=event_log, event_bus=event_bus),
+                        name="events_new"),
+        tornado.web.url(r"/([a-z]+)/events/bulk",
+                        EventsHandlerBulk,
+                        dict(supported_agencies=SUPPORTED_AGENCIES, event_index=event_index, clock=clock,
+                             event_log=event_log, event_bus=event_bus),
+                        name="events_bulk")
+    ], log_function=log_request)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
     try:
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         tornado.ioloop.IOLoop.instance().stop()
+        event_log.stop()
+        if event_bus is not None:
+            event_bus.close()
+        stop_logging()
 
 
 if __name__ == "__main__":
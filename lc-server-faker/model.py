@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+import calendar
+import datetime
+import dateutil.parser
+from array import array
+
+MISSING = -(2 ** 31)
+CONNECTION_KEYS = ["@id", "@type", "departureStop", "arrivalStop", "departureTime", "arrivalTime",
+                   "departureDelay", "arrivalDelay", "direction", "gtfs:trip", "gtfs:route",
+                   "gtfs:pickupType", "gtfs:dropOffType"]
+
+
+def parse_time(value):
+    # Fast path for the fixed ISO format used in the fragments (UTC, optional fraction), seconds since the epoch
+    if len(value) >= 20 and value[-1] == "Z" and value[19] in ".Z" and value[4] == value[7] == "-" \
+            and value[10] == "T" and value[13] == value[16] == ":":
+        try:
+            return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                    int(value[11:13]), int(value[14:16]), int(value[17:19])))
+        except ValueError:
+            pass
+    # Offsets such as +01:00 and any other format go through the full parser
+    return calendar.timegm(dateutil.parser.parse(value).utctimetuple())
+
+
+def format_time(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds).isoformat() + ".000Z"
+
+
+class UriTable(object):
+    def __init__(self):
+        self.uris = []
+        self.codes = {}
+
+    def intern(self, uri):
+        code = self.codes.get(uri)
+        if code is None:
+            code = len(self.uris)
+            self.codes[uri] = code
+            self.uris.append(uri)
+        return code
+
+    def lookup(self, uri):
+        return self.codes.get(uri, MISSING)
+
+    def __getitem__(self, code):
+        return self.uris[code]
+
+    def __len__(self):
+        return len(self.uris)
+
+
+class ConnectionView(object):
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def id(self):
+        return self.table.ids[self.row]
+
+    @property
+    def departure_stop(self):
+        return self.table.uris[self.table.departure_stops[self.row]]
+
+    @property
+    def arrival_stop(self):
+        return self.table.uris[self.table.arrival_stops[self.row]]
+
+    @property
+    def departure_time(self):
+        return self.table.departure_times[self.row]
+
+    @property
+    def arrival_time(self):
+        return self.table.arrival_times[self.row]
+
+    @property
+    def route(self):
+        return self.table.uris[self.table.routes[self.row]]
+
+    def to_jsonld(self):
+        return self.table.render(self.row)
+
+
+class ConnectionTable(object):
+    # Column per property, URIs and other repeated strings are integer codes into a shared UriTable
+    CODED = [("@type", "types"), ("departureStop", "departure_stops"), ("arrivalStop", "arrival_stops"),
+             ("direction", "directions"), ("gtfs:trip", "trips"), ("gtfs:route", "routes"),
+             ("gtfs:pickupType", "pickup_types"), ("gtfs:dropOffType", "drop_off_types")]
+    TIMES = [("departureTime", "departure_times"), ("arrivalTime", "arrival_times")]
+    DELAYS = [("departureDelay", "departure_delays"), ("arrivalDelay", "arrival_delays")]
+    LAYOUT = sorted([(k, c, "uri") for k, c in CODED] + [(k, c, "time") for k, c in TIMES]
+                    + [(k, c, "delay") for k, c in DELAYS], key=lambda k: CONNECTION_KEYS.index(k[0]))
+    # Columns with an inverted index, by query parameter
+    INDEXED = {"departureStop": "departure_stops", "arrivalStop": "arrival_stops", "route": "routes"}
+
+    def __init__(self, uris, connections=()):
+        self.uris = uris
+        self.ids = []
+        for _, column in self.CODED + self.DELAYS:
+            setattr(self, column, array("i"))
+        for _, column in self.TIMES:
+            setattr(self, column, array("q"))
+        # Properties without a column, by connection @id
+        self.extras = {}
+        for c in connections:
+            self.insert(len(self.ids), c)
+        # Code to sorted rows for every indexed column, dropped when the table changes
+        self.postings = {}
+        for column in self.INDEXED.values():
+            self.index(column)
+
+    def copy(self):
+        table = ConnectionTable.__new__(ConnectionTable)
+        table.uris = self.uris
+        table.ids = list(self.ids)
+        for _, column in self.CODED + self.TIMES + self.DELAYS:
+            setattr(table, column, array(getattr(self, column).typecode, getattr(self, column)))
+        table.extras = dict(self.extras)
+        table.postings = {}
+        return table
+
+    def insert(self, row, connection):
+        self.postings = {}
+        self.ids.insert(row, connection["@id"])
+        for key, column in self.CODED:
+            getattr(self, column).insert(row, self.uris.intern(connection[key]) if key in connection else MISSING)
+        for key, column in self.TIMES:
+            getattr(self, column).insert(row, parse_time(connection[key]))
+        for key, column in self.DELAYS:
+            getattr(self, column).insert(row, int(connection[key]) if key in connection else MISSING)
+        extras = {k: v for k, v in connection.items() if k not in CONNECTION_KEYS}
+        if len(extras) > 0:
+            self.extras[connection["@id"]] = extras
+        else:
+            self.extras.pop(connection["@id"], None)
+
+    def delete(self, row):
+        self.postings = {}
+        self.extras.pop(self.ids[row], None)
+        del self.ids[row]
+        for _, column in self.CODED + self.TIMES + self.DELAYS:
+            del getattr(self, column)[row]
+
+    def index(self, column):
+        if column not in self.postings:
+            postings = {}
+            for row, code in enumerate(getattr(self, column)):
+                postings.setdefault(code, array("i")).append(row)
+            self.postings[column] = postings
+        return self.postings[column]
+
+    def select(self, codes):
+        # Intersect the postings of every column, starting with the shortest list
+        candidates = sorted((self.index(column).get(code, ()) for column, code in codes.items()), key=len)
+        rows = set(candidates[0])
+        for postings in candidates[1:]:
+            rows.intersection_update(postings)
+        return sorted(rows)
+
+    def position(self, connection_id):
+        return self.ids.index(connection_id)
+
+    def render(self, row):
+        # JSON-LD is only built when the connection is serialized
+        connection = {"@id": self.ids[row]}
+        for key, column, kind in self.LAYOUT:
+            value = getattr(self, column)[row]
+            if kind == "time":
+                connection[key] = format_time(value)
+            elif value != MISSING:
+                connection[key] = self.uris[value] if kind == "uri" else value
+        connection.update(self.extras.get(self.ids[row], {}))
+        return connection
+
+    def __getitem__(self, row):
+        return ConnectionView(self, row)
+
+    def __iter__(self):
+        for row in range(0, len(self.ids)):
+            yield ConnectionView(self, row)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Fragment(object):
+    __slots__ = ("header", "table")
+
+    def __init__(self, header, table):
+        self.header = header
+        self.table = table
+
+    def copy(self):
+        return Fragment(self.header, self.table.copy())
+
+    def to_jsonld(self, rows=None):
+        fragment = dict(self.header)
+        if rows is None:
+            rows = range(0, len(self.table))
+        fragment["@graph"] = [self.table.render(row) for row in rows]
+        return fragment
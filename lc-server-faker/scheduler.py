@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import bisect
+import heapq
+import logging
+import tornado.ioloop
+
+logger = logging.getLogger(__name__)
+
+
+class EventScheduler(object):
+    def __init__(self, event_index, callback, clock):
+        self.event_index = event_index
+        self.callback = callback
+        self.clock = clock
+        # Min-heap with the result times (seconds of the day) which are still due today
+        self.heap = []
+        self.timeout = None
+        self.deadline = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.event_index.listeners.append(self.push)
+        self._reload()
+        self._arm()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.event_index.listeners.remove(self.push)
+        self._cancel()
+        self.heap = []
+
+    def push(self, keys, events):
+        # New events: run now if any is already due, otherwise re-arm if one of them is the next one
+        now = self._now()
+        due = False
+        for key in keys:
+            if key <= now:
+                due = True
+            else:
+                heapq.heappush(self.heap, key)
+        if due:
+            tornado.ioloop.IOLoop.current().add_callback(self._fire)
+        elif len(self.heap) > 0 and (self.deadline is None or self.heap[0] < self.deadline):
+            self._arm()
+
+    def _reload(self):
+        # The index is sorted, so its future keys are already a valid heap
+        now = int(self._now())
+        keys = self.event_index.keys
+        self.heap = sorted(set(keys[bisect.bisect_right(keys, now):]))
+
+    def _arm(self):
+        self._cancel()
+        if not self.running:
+            return
+        now = self._now()
+        if len(self.heap) > 0:
+            self.deadline = self.heap[0]
+        else:
+            # Nothing left today, wake up at midnight to start over
+            self.deadline = 24 * 3600
+        io_loop = tornado.ioloop.IOLoop.current()
+        self.timeout = io_loop.call_at(io_loop.time() + self.clock.delay(max(self.deadline - now, 0)), self._fire)
+
+    def _cancel(self):
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+            self.deadline = None
+
+    def _fire(self):
+        if not self.running:
+            return
+        now = self._now()
+        if self.deadline is not None and self.deadline >= 24 * 3600 and now < 3600:
+            self._reload()
+        while len(self.heap) > 0 and self.heap[0] <= now:
+            heapq.heappop(self.heap)
+        # A failing callback must not stop the following events
+        try:
+            self.callback()
+        except Exception:
+            logger.exception("Handling the due events FAILED")
+        finally:
+            self._arm()
+
+    def _now(self):
+        return self.clock.seconds_of_day()
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Formats of the pushed event pages, the binary formats need a WebSocket
+FORMATS = ["json"] + (["msgpack"] if msgpack is not None else []) + (["cbor"] if cbor2 is not None else [])
+BINARY_FORMATS = ["msgpack", "cbor"]
+
+
+def serialize(page, format):
+    if format == "msgpack":
+        return msgpack.packb(page, use_bin_type=True)
+    if format == "cbor":
+        return cbor2.dumps(page)
+    return json.dumps(page)
+
+
+class PushMessage(object):
+    def __init__(self, page, cursor=None):
+        # Serialized at most once per format and context mode, whatever the number of subscribers
+        self.page = page
+        # Result time and number of events of that second which were sent before this page
+        self.cursor = cursor
+        self.bodies = {}
+
+    def body(self, format, context=True):
+        key = (format, context)
+        if key not in self.bodies:
+            page = self.page if context else {k: v for k, v in self.page.items() if k != "@context"}
+            self.bodies[key] = serialize(page, format)
+        return self.bodies[key]
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import datetime
+import dateutil.parser
+import json
+import logging
+import os
+import re
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+ISO_DATE = re.compile(rb"(\d{4})-(\d{2})-(\d{2})T")
+
+
+def load_exceptions(path):
+    # {"2019-12-25": ["*"], "2019-12-24": ["http://irail.be/vehicle/IC1832"]}: routes without service on a date
+    if path is None:
+        return {}
+    with open(path, "r") as json_file:
+        exceptions = json.load(json_file)
+    return {dateutil.parser.parse(date).date(): set(routes) for date, routes in exceptions.items()}
+
+
+class ServiceCalendar(object):
+    def __init__(self, fragment_store, first_date, weeks, exceptions=None):
+        # The stored fragments are a template day, which is served on every date of the range, shifted to that
+        # date and without the routes which have no service on it
+        self.fragment_store = fragment_store
+        self.template_date = min(dateutil.parser.parse(os.path.splitext(os.path.basename(p))[0]).date()
+                                 for p in fragment_store.paths)
+        self.first_date = first_date
+        self.end_date = first_date + datetime.timedelta(weeks=weeks)
+        self.exceptions = exceptions if exceptions is not None else {}
+        # The materialized pages are only kept by the fragment cache, within its budget
+        self.materialized = 0
+
+    def __contains__(self, date):
+        return self.first_date <= date < self.end_date
+
+    def body(self, date, index, live):
+        # The live day follows the patched pages, the other days only know the planned ones
+        return self._materialize(date, self.fragment_store.body(index) if live else self.fragment_store.original(index))
+
+    def filtered_body(self, date, index, live, filters):
+        # The filters select the rows through the indexes of the stored page, before it is moved to the date
+        return self._materialize(date, self.fragment_store.filtered_body(index, filters, original=not live))
+
+    def _materialize(self, date, body):
+        self.materialized += 1
+        removed = self.exceptions.get(date)
+        if removed:
+            fragment = json.loads(bytes(body).decode("utf-8"))
+            fragment["@graph"] = [] if "*" in removed else [c for c in fragment["@graph"]
+                                                              if c.get("gtfs:route") not in removed]
+            body = json.dumps(fragment).encode("utf-8")
+
+        shift = date - self.template_date
+        if shift.days == 0:
+            return body
+
+        # Every date moves along, including the next day of trips running past midnight and the hydra links,
+        # and the date in the URIs of the connections
+        shifted = {}
+
+        def shift_date(match):
+            value = match.group(0)
+            if value not in shifted:
+                original = datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+                shifted[value] = (original + shift).isoformat().encode("utf-8") + b"T"
+            return shifted[value]
+
+        body = ISO_DATE.sub(shift_date, bytes(body))
+        return body.replace(self.template_date.strftime("/%Y%m%d/").encode("utf-8"),
+                            date.strftime("/%Y%m%d/").encode("utf-8"))
+
+    def stats(self):
+        return {
+            "materialized": self.materialized
+        }
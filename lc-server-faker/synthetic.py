@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import random
+from model import format_time, parse_time
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+SYNTHETIC_URL = "http://example.org/synthetic"
+FRAGMENT_BASE = "http://localhost:8080/sncb/connections?departureTime="
+CONTEXT = {
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "lc": "http://semweb.mmlab.be/ns/linkedconnections#",
+    "hydra": "http://www.w3.org/ns/hydra/core#",
+    "gtfs": "http://vocab.gtfs.org/terms#",
+    "Connection": "lc:Connection",
+    "CancelledConnection": "lc:CancelledConnection",
+    "departureStop": {"@type": "@id", "@id": "lc:departureStop"},
+    "arrivalStop": {"@type": "@id", "@id": "lc:arrivalStop"},
+    "departureTime": {"@id": "lc:departureTime", "@type": "xsd:dateTime"},
+    "arrivalTime": {"@id": "lc:arrivalTime", "@type": "xsd:dateTime"},
+    "departureDelay": {"@id": "lc:departureDelay", "@type": "xsd:integer"},
+    "arrivalDelay": {"@id": "lc:arrivalDelay", "@type": "xsd:integer"},
+    "direction": {"@id": "gtfs:headsign", "@type": "xsd:string"},
+    "gtfs:trip": {"@type": "@id"},
+    "gtfs:route": {"@type": "@id"},
+    "gtfs:pickupType": {"@type": "@id"},
+    "gtfs:dropOffType": {"@type": "@id"},
+    "gtfs:Regular": {"@type": "@id"},
+    "hydra:next": {"@type": "@id"},
+    "hydra:previous": {"@type": "@id"},
+    "hydra:property": {"@type": "@id"},
+    "hydra:variableRepresentation": {"@type": "@id"}
+}
+
+
+class Route(object):
+    def __init__(self, agency, number, stops, hops, first_departure, headway, trips):
+        self.agency = agency
+        self.number = number
+        self.stops = stops
+        # Departure and arrival of every hop, relative to the departure of the trip
+        self.hops = hops
+        self.first_departure = first_departure
+        self.headway = headway
+        self.trips = trips
+
+    def uri(self):
+        return "{0}/{1}/routes/{2}".format(SYNTHETIC_URL, self.agency, self.number)
+
+    def connection(self, day, trip, hop, departure_time, arrival_time):
+        trip_id = "{0}/{1}/trips/{2}/{3}/{4}".format(SYNTHETIC_URL, self.agency, self.number, day, trip)
+        return {
+            "@id": "{0}/{1}/connections/{2}/{3}/{4}/{5}".format(SYNTHETIC_URL, self.agency, self.number, day, trip,
+                                                                hop),
+            "@type": "Connection",
+            "departureStop": self.stops[hop],
+            "arrivalStop": self.stops[hop + 1],
+            "departureTime": format_time(departure_time),
+            "arrivalTime": format_time(arrival_time),
+            "departureDelay": 0,
+            "arrivalDelay": 0,
+            "direction": "Stop {0}".format(self.stops[-1].rsplit("/", 1)[1]),
+            "gtfs:trip": trip_id,
+            "gtfs:route": self.uri(),
+            "gtfs:pickupType": "gtfs:Regular",
+            "gtfs:dropOffType": "gtfs:Regular"
+        }
+
+
+def build_network(stops, routes, route_length, trips, headway, agencies, first_departure, rng):
+    # Every route visits a random sequence of stops, the agencies share the stops so trips can transfer
+    stop_uris = ["{0}/stops/{1}".format(SYNTHETIC_URL, i) for i in range(0, stops)]
+    network = []
+    for r in range(0, routes):
+        sequence = rng.sample(stop_uris, min(route_length, stops))
+        hops = []
+        offset = 0
+        for _ in range(0, len(sequence) - 1):
+            # Two to ten minutes between stops, one minute dwell time
+            arrival = offset + rng.randint(2, 10) * 60
+            hops.append((offset, arrival))
+            offset = arrival + 60
+        start = first_departure + rng.randrange(0, headway) * 60
+        network.append(Route("agency{0}".format(r % agencies), r, sequence, hops, start, headway * 60, trips))
+    return network
+
+
+def connections(network, start, days):
+    # Every hop of every route departs at a fixed headway, so a heap of these progressions yields all connections
+    # sorted by departureTime without holding them in memory
+    heap = []
+    for r, route in enumerate(network):
+        for h, (departure, _) in enumerate(route.hops):
+            if route.trips > 0:
+                heap.append((start + route.first_departure + departure, r, h, 0, 0))
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        departure_time, r, h, day, trip = heapq.heappop(heap)
+        route = network[r]
+        departure, arrival = route.hops[h]
+        yield departure_time, route.connection(day, trip, h, departure_time, departure_time - departure + arrival)
+        if trip + 1 < route.trips:
+            heapq.heappush(heap, (departure_time + route.headway, r, h, day, trip + 1))
+        elif day + 1 < days:
+            heapq.heappush(heap, (start + (day + 1) * DAY + route.first_departure + departure, r, h, day + 1, 0))
+
+
+def generate_network(directory="connections", stops=1000, routes=200, route_length=10, trips=40, headway=20,
+                     days=1, agencies=1, page_window=10, start=START_TIME, seed=None):
+    # The server keys the pages on the time of day, later days would collide with the first one. Every day of
+    # the network is the same, so main.py --weeks serves it on the other dates instead.
+    if days != 1:
+        raise ValueError("Only a single day can be served, repeat it with main.py --weeks")
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    rng = random.Random(seed)
+    start = parse_time(start) - parse_time(start) % DAY
+    end = start + days * DAY
+    network = build_network(stops, routes, route_length, trips, headway, agencies, 5 * 3600, rng)
+
+    # A page for every window of the day, also the empty ones, so the hydra:next chain has no gaps. Trips running
+    # past midnight stay on the last page: a page on the next day would repeat the time of day of the first pages.
+    window = page_window * 60
+    pages = 0
+    count = 0
+    page_start = start
+    graph = []
+    for departure_time, c in connections(network, start, days):
+        while departure_time >= page_start + window and page_start + window < end:
+            _save_page(directory, page_start, window, graph)
+            pages += 1
+            page_start += window
+            graph = []
+        graph.append(c)
+        count += 1
+    while page_start < end:
+        _save_page(directory, page_start, window, graph)
+        pages += 1
+        page_start += window
+        graph = []
+    logger.info("Generated %d connections of %d routes in %d fragments", count, len(network), pages)
+
+
+def _save_page(directory, page_start, window, graph):
+    fragment = {
+        "@context": CONTEXT,
+        "@id": FRAGMENT_BASE + format_time(page_start),
+        "@type": "hydra:PartialCollectionView",
+        "hydra:next": FRAGMENT_BASE + format_time(page_start + window),
+        "hydra:previous": FRAGMENT_BASE + format_time(page_start - window),
+        "hydra:search": {
+            "@type": "hydra:IriTemplate",
+            "hydra:template": "http://localhost:8080/sncb/connections{?departureTime}",
+            "hydra:variableRepresentation": "hydra:BasicRepresentation",
+            "hydra:mapping": {
+                "@type": "IriTemplateMapping",
+                "hydra:variable": "departureTime",
+                "hydra:required": True,
+                "hydra:property": "lc:departureTimeQuery"
+            }
+        },
+        "@graph": graph
+    }
+
+    # A partially written file is never picked up, like the downloaded fragments
+    path = os.path.join(directory, format_time(page_start) + ".jsonld")
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(fragment, json_file)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic network as Linked Connections fragments.")
+    parser.add_argument("-d", "--directory",
+                        default="connections",
+                        help="Directory for the fragments.")
+    parser.add_argument("-s", "--stops",
+                        default=1000,
+                        type=int,
+                        help="Number of stops.")
+    parser.add_argument("-r", "--routes",
+                        default=200,
+                        type=int,
+                        help="Number of routes.")
+    parser.add_argument("-rl", "--routelength",
+                        default=10,
+                        type=int,
+                        help="Number of stops of every route.")
+    parser.add_argument("-t", "--trips",
+                        default=40,
+                        type=int,
+                        help="Number of trips per route and per day.")
+    parser.add_argument("-hw", "--headway",
+                        default=20,
+                        type=int,
+                        help="Minutes between the trips of a route.")
+    parser.add_argument("-da", "--days",
+                        default=1,
+                        type=int,
+                        help="Number of days, only a single day can be served (repeat it with main.py --weeks).")
+    parser.add_argument("-a", "--agencies",
+                        default=1,
+                        type=int,
+                        help="Number of agencies operating the routes.")
+    parser.add_argument("-pw", "--pagewindow",
+                        default=10,
+                        type=int,
+                        help="Minutes covered by every fragment.")
+    parser.add_argument("-st", "--start",
+                        default=START_TIME,
+                        help="First day (UTC), today by default.")
+    parser.add_argument("--seed",
+                        default=None,
+                        type=int,
+                        help="Seed of the network layout.")
+    args = parser.parse_args()
+    if args.days != 1:
+        parser.error("--days must be 1, repeat the day with main.py --weeks")
+    logging.basicConfig(level=logging.INFO)
+    generate_network(args.directory, args.stops, args.routes, args.routelength, args.trips, args.headway, args.days,
+                     args.agencies, args.pagewindow, args.start, args.seed)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import tornado.ioloop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lc-server-faker"))
+from backpressure import STATS, SubscriberBuffer
+from serialization import PushMessage
+
+CAPACITY = 4
+
+
+def event(connection, n):
+    return {
+        "@id": "http://irail.be/connections/{0}#{1}".format(connection, n),
+        "@type": "Event",
+        "sosa:resultTime": "2019-01-01T07:10:{0:02d}.000Z".format(n),
+        "sosa:hasResult": {
+            "@type": "sosa:hasResult",
+            "Connection": {
+                "@id": "http://irail.be/connections/{0}".format(connection),
+                "@type": "Connection"
+            }
+        }
+    }
+
+
+def message(cursor, *events):
+    return PushMessage({"@id": "page{0}".format(cursor[0]), "@graph": list(events)}, cursor)
+
+
+def ids(buffer):
+    return [e["@id"].rsplit("/", 1)[1] for m in buffer.messages for e in m.page["@graph"]]
+
+
+def stats():
+    return dict(STATS)
+
+
+# Under its capacity every policy keeps the pages as they are
+for policy in ["drop", "disconnect"]:
+    buffer = SubscriberBuffer(CAPACITY, policy)
+    before = stats()
+    assert buffer.put(message((1, 0), event("a", 1), event("b", 2)))
+    assert buffer.put(message((2, 0), event("a", 3), event("c", 4)))
+    assert len(buffer) == 2 and buffer.events == 4
+    assert ids(buffer) == ["a#1", "b#2", "a#3", "c#4"]
+    assert stats() == before
+print("Within capacity OK")
+
+# drop: the pages are merged and only the newest events are kept
+buffer = SubscriberBuffer(CAPACITY, "drop")
+before = stats()
+buffer.put(message((1, 0), event("a", 1), event("b", 2), event("c", 3)))
+assert buffer.put(message((4, 0), event("a", 4), event("d", 5), event("e", 6)))
+assert len(buffer) == 1 and buffer.events == CAPACITY
+assert ids(buffer) == ["c#3", "a#4", "d#5", "e#6"]
+assert buffer.messages[0].page["@id"] == "page1"
+assert buffer.cursor() == (1, 0)
+assert STATS["dropped"] == before["dropped"] + 2
+assert STATS["coalesced"] == before["coalesced"]
+print("Drop policy OK")
+
+# coalesce: only the latest event of every connection is kept, even within the capacity
+buffer = SubscriberBuffer(CAPACITY, "coalesce")
+before = stats()
+buffer.put(message((1, 0), event("a", 1), event("b", 2)))
+assert buffer.put(message((3, 0), event("a", 3), event("b", 4)))
+assert len(buffer) == 1 and buffer.events == 2
+assert ids(buffer) == ["a#3", "b#4"]
+assert STATS["coalesced"] == before["coalesced"] + 2
+assert STATS["dropped"] == before["dropped"]
+
+# coalesce: the oldest events are dropped when the connections alone do not fit
+assert buffer.put(message((5, 0), event("c", 5), event("d", 6), event("e", 7), event("a", 8)))
+assert buffer.events == CAPACITY
+assert ids(buffer) == ["c#5", "d#6", "e#7", "a#8"]
+assert buffer.cursor() == (1, 0)
+assert STATS["coalesced"] == before["coalesced"] + 3
+assert STATS["dropped"] == before["dropped"] + 1
+print("Coalesce policy OK")
+
+# disconnect: put() asks for a disconnect, the cursor points at the oldest page which was not written
+buffer = SubscriberBuffer(CAPACITY, "disconnect")
+before = stats()
+buffer.put(message((1, 2), event("a", 1), event("b", 2), event("c", 3)))
+assert not buffer.put(message((4, 0), event("a", 4), event("d", 5)))
+assert buffer.cursor() == (1, 2)
+assert stats() == before
+buffer.close(PushMessage({"status": 503}))
+assert len(buffer) == 1 and buffer.events == 0
+assert buffer.put(message((6, 0), event("f", 6)))
+assert len(buffer) == 1
+
+
+async def drain():
+    messages = []
+    while True:
+        m = await buffer.get()
+        if m is None:
+            return messages
+        messages.append(m)
+
+
+messages = tornado.ioloop.IOLoop.current().run_sync(drain)
+assert [m.page for m in messages] == [{"status": 503}]
+assert buffer.cursor() is None
+print("Disconnect policy OK")
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import random
+import resource
+import sys
+import time
+import websockets
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+PROTOCOL_HTTP = "http://"
+PROTOCOL_WS = "ws://"
+HOST = "127.0.0.1:8080"
+# Injected events are recognized by their @id, they refer to a connection which is not in the dataset
+BENCHMARK_CONNECTION = "http://irail.be/connections/benchmark"
+
+
+def summarize(samples, duration=None):
+    # Latencies in milliseconds, nearest-rank percentiles
+    samples = sorted(samples)
+    summary = {"count": len(samples)}
+    if duration:
+        summary["throughput"] = len(samples) / duration
+    if len(samples) > 0:
+        for p in [50, 95, 99]:
+            summary["p{0}".format(p)] = samples[max(int(math.ceil(p / 100 * len(samples))) - 1, 0)] * 1000
+        summary["mean"] = sum(samples) / len(samples) * 1000
+        summary["max"] = samples[-1] * 1000
+    return summary
+
+
+def format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).replace(microsecond=0).isoformat() + ".000Z"
+
+
+def departure_time(rng):
+    # Most trips are planned around the morning and evening peaks, the rest spread over the day
+    r = rng.random()
+    if r < 0.3:
+        hour = rng.gauss(8, 1)
+    elif r < 0.6:
+        hour = rng.gauss(17.5, 1.5)
+    else:
+        hour = rng.uniform(5, 24)
+    seconds = int(hour * 3600) % (24 * 3600)
+    today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return (today + datetime.timedelta(seconds=seconds)).isoformat() + ".000Z"
+
+
+async def timed_fetch(client, url, latencies, errors):
+    start = time.perf_counter()
+    response = await client.fetch(url, raise_error=False)
+    if response.code == 200:
+        latencies.append(time.perf_counter() - start)
+    else:
+        errors.append(response.code)
+
+
+async def benchmark_connections(args, client):
+    # Closed loop: every client sends its next request as soon as the previous one is answered
+    rng = random.Random(args.seed)
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+
+    async def run():
+        while time.perf_counter() < deadline:
+            await timed_fetch(client, PROTOCOL_HTTP + args.host + "/sncb/connections?departureTime="
+                              + departure_time(rng), latencies, errors)
+
+    await asyncio.gather(*[run() for _ in range(0, args.concurrency)])
+    result = summarize(latencies, args.duration)
+    result["errors"] = len(errors)
+    return result
+
+
+async def benchmark_polling(args, client):
+    # Open loop: every client polls at a fixed rate, whether the server keeps up or not
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+
+    async def run(offset):
+        await asyncio.sleep(offset)
+        requests = []
+        while time.perf_counter() < deadline:
+            last_sync_time = format_time(time.time() - args.poll_window)
+            requests.append(asyncio.ensure_future(timed_fetch(
+                client, PROTOCOL_HTTP + args.host + "/sncb/events?lastSyncTime=" + last_sync_time, latencies, errors)))
+            await asyncio.sleep(1 / args.poll_rate)
+        await asyncio.gather(*requests)
+
+    await asyncio.gather(*[run(i / args.poll_rate / args.poll_clients) for i in range(0, args.poll_clients)])
+    result = summarize(latencies, args.duration)
+    result["errors"] = len(errors)
+    return result
+
+
+def received_events(message, lags, seen):
+    # Delivery lag of the injected events against their sosa:resultTime
+    now = time.time()
+    for e in json.loads(message).get("@graph", []):
+        if e.get("@id", "").startswith(BENCHMARK_CONNECTION) and e["@id"] not in seen:
+            seen.add(e["@id"])
+            result_time = datetime.datetime.strptime(e["sosa:resultTime"], "%Y-%m-%dT%H:%M:%S.000Z")
+            lags.append(now - (result_time - datetime.datetime(1970, 1, 1)).total_seconds())
+
+
+async def sse_subscriber(args, client, lags, stop):
+    seen = set()
+    buffer = [""]
+
+    def on_chunk(chunk):
+        buffer[0] += chunk.decode("utf-8")
+        *messages, buffer[0] = buffer[0].split("\n\n")
+        for m in messages:
+            if m.startswith("data: "):
+                received_events(m[6:], lags, seen)
+
+    request = HTTPRequest(PROTOCOL_HTTP + args.host + "/sncb/events/sse?lastSyncTime=" + format_time(time.time()),
+                          streaming_callback=on_chunk, request_timeout=args.duration + 60)
+    fetch = asyncio.ensure_future(client.fetch(request, raise_error=False))
+    await asyncio.wait([fetch, stop], return_when=asyncio.FIRST_COMPLETED)
+    fetch.cancel()
+    return seen
+
+
+async def ws_subscriber(args, lags, stop):
+    seen = set()
+    try:
+        async with websockets.connect(PROTOCOL_WS + args.host + "/sncb/events/ws", max_queue=None) as websocket:
+            await websocket.send(format_time(time.time()))
+            while not stop.done():
+                receive = asyncio.ensure_future(websocket.recv())
+                await asyncio.wait([receive, stop], return_when=asyncio.FIRST_COMPLETED)
+                if receive.done():
+                    received_events(receive.result(), lags, seen)
+                else:
+                    receive.cancel()
+    except (OSError, websockets.exceptions.WebSocketException):
+        pass
+    return seen
+
+
+async def inject_event(client, args, index, result_time):
+    event = {
+        "@id": "{0}#{1}".format(BENCHMARK_CONNECTION, index),
+        "@type": "Event",
+        "sosa:resultTime": format_time(result_time),
+        "sosa:hasResult": {
+            "@type": "sosa:hasResult",
+            "Connection": {
+                "@id": BENCHMARK_CONNECTION,
+                "@type": "CanceledConnection"
+            }
+        }
+    }
+    await client.fetch(PROTOCOL_HTTP + args.host + "/sncb/events/bulk", method="POST", body=json.dumps([event]))
+
+
+async def benchmark_push(args, client):
+    # Subscribe everyone first, then inject events which become due a little later
+    sse_lags = []
+    ws_lags = []
+    stop = asyncio.get_event_loop().create_future()
+    subscribers = []
+    for i in range(0, max(args.sse, args.ws)):
+        if i < args.sse:
+            subscribers.append(asyncio.ensure_future(sse_subscriber(args, client, sse_lags, stop)))
+        if i < args.ws:
+            subscribers.append(asyncio.ensure_future(ws_subscriber(args, ws_lags, stop)))
+        if i % 100 == 99:
+            await asyncio.sleep(0.1)
+    await asyncio.sleep(args.settle)
+
+    injected = 0
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        await inject_event(client, args, injected, math.ceil(time.time()) + args.event_lead)
+        injected += 1
+        await asyncio.sleep(1 / args.event_rate)
+    await asyncio.sleep(args.event_lead + args.settle)
+    stop.set_result(True)
+    await asyncio.gather(*subscribers)
+
+    result = {"events": injected}
+    for name, lags, subscriber_count in [("sse", sse_lags, args.sse), ("ws", ws_lags, args.ws)]:
+        result[name] = summarize(lags)
+        result[name]["subscribers"] = subscriber_count
+        result[name]["expected"] = injected * subscriber_count
+    return result
+
+
+def compare(results, baseline, tolerance):
+    # Throughput must not drop and p99 latency must not rise by more than the tolerance
+    regressions = []
+    for name in ["connections", "polling"]:
+        if name not in results or name not in baseline:
+            continue
+        current, previous = results[name], baseline[name]
+        if current.get("throughput", 0) < previous.get("throughput", 0) * (1 - tolerance):
+            regressions.append("{0} throughput {1:.1f} < {2:.1f}".format(name, current["throughput"],
+                                                                         previous["throughput"]))
+        if current.get("p99", 0) > previous.get("p99", float("inf")) * (1 + tolerance):
+            regressions.append("{0} p99 {1:.1f}ms > {2:.1f}ms".format(name, current["p99"], previous["p99"]))
+    for name in ["sse", "ws"]:
+        if "push" not in results or "push" not in baseline:
+            continue
+        current, previous = results["push"][name], baseline["push"][name]
+        if current.get("p99", 0) > previous.get("p99", float("inf")) * (1 + tolerance):
+            regressions.append("{0} lag p99 {1:.1f}ms > {2:.1f}ms".format(name, current["p99"], previous["p99"]))
+    return regressions
+
+
+async def run(args):
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency + args.poll_clients * 10 + args.sse + 10)
+    client = AsyncHTTPClient()
+    results = {"host": args.host, "duration": args.duration, "seed": args.seed}
+    if "connections" in args.scenarios:
+        print("Benchmarking /connections with {0} clients".format(args.concurrency), file=sys.stderr)
+        results["connections"] = await benchmark_connections(args, client)
+    if "polling" in args.scenarios:
+        print("Benchmarking /events with {0} clients at {1} req/s".format(args.poll_clients, args.poll_rate),
+              file=sys.stderr)
+        results["polling"] = await benchmark_polling(args, client)
+    if "push" in args.scenarios:
+        print("Benchmarking {0} SSE and {1} WebSocket subscribers".format(args.sse, args.ws), file=sys.stderr)
+        results["push"] = await benchmark_push(args, client)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator and latency benchmark for a running server.")
+    parser.add_argument("--host", default=HOST, help="Host and port of the server.")
+    parser.add_argument("--scenarios", default="connections,polling,push",
+                        help="Comma separated scenarios: connections, polling and push.")
+    parser.add_argument("--duration", default=10, type=float, help="Duration of every scenario (seconds).")
+    parser.add_argument("--seed", default=0, type=int, help="Seed for the departureTime distribution.")
+    parser.add_argument("--concurrency", default=32, type=int, help="Concurrent /connections clients.")
+    parser.add_argument("--poll-clients", default=16, type=int, help="Concurrent /events polling clients.")
+    parser.add_argument("--poll-rate", default=5, type=float, help="Requests per second of every polling client.")
+    parser.add_argument("--poll-window", default=60, type=int, help="lastSyncTime of the polls (seconds ago).")
+    parser.add_argument("--sse", default=1000, type=int, help="Number of SSE subscribers.")
+    parser.add_argument("--ws", default=1000, type=int, help="Number of WebSocket subscribers.")
+    parser.add_argument("--event-rate", default=2, type=float, help="Injected events per second.")
+    parser.add_argument("--event-lead", default=2, type=int,
+                        help="Injected events become due this many seconds after they are posted.")
+    parser.add_argument("--settle", default=2, type=float, help="Time to connect and drain the subscribers.")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--baseline", default=None, help="Earlier JSON results to compare with.")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="Allowed relative regression.")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+
+    # Every subscriber holds a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for r in regressions:
+            print("REGRESSION: " + r, file=sys.stderr)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lc-server-faker"))
+from eventindex import EventIndex
+from events import decode_cursor, encode_cursor
+
+PAGE_SIZE = 3
+END = 24 * 3600 - 1
+
+
+def event(n, time):
+    return {
+        "@id": "http://irail.be/connections/{0}#event".format(n),
+        "@type": "Event",
+        "sosa:resultTime": "2019-01-01T{0}.000Z".format(time),
+        "sosa:hasResult": {
+            "@type": "sosa:hasResult",
+            "Connection": {
+                "@id": "http://irail.be/connections/{0}".format(n),
+                "@type": "CanceledConnection"
+            }
+        }
+    }
+
+
+def page_all(index, cursor):
+    # Follow hydra:next like a client would, until a page comes back empty
+    seen = []
+    for _ in range(0, len(index) + 1):
+        start, skip = decode_cursor(cursor)
+        graph, (key, last_skip) = index.page(start, skip, END, PAGE_SIZE)
+        if len(graph) == 0:
+            return seen, cursor
+        assert len(graph) <= PAGE_SIZE
+        seen.extend(e["@id"] for e in graph)
+        cursor = encode_cursor(key, last_skip)
+    raise AssertionError("The cursor does not advance")
+
+
+# Seven events share 07:10:00, so every page ends in the middle of that second
+times = ["07:09:59"] + ["07:10:00"] * 7 + ["07:10:01", "07:10:01", "07:12:00"]
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, "events.jsonld")
+    with open(path, "w") as json_file:
+        json.dump([event(n, time) for n, time in enumerate(times)], json_file)
+    index = EventIndex(path, os.path.join(directory, "events.jsonl"))
+
+    seen, cursor = page_all(index, encode_cursor(0, 0))
+    assert sorted(seen) == sorted(event(n, time)["@id"] for n, time in enumerate(times))
+    assert len(seen) == len(set(seen))
+    print("Paging within a second OK")
+
+    # Events which arrive late for a second that was already returned are on the next page, once
+    start, skip = decode_cursor(encode_cursor(0, 0))
+    graph, (key, last_skip) = index.page(start, skip, END, PAGE_SIZE * 2)
+    assert key == 7 * 3600 + 10 * 60 and 0 < last_skip < 7
+    index.add(event(100, "07:10:00"))
+    index.extend([event(101, "07:09:59"), event(102, "07:10:00")])
+    seen_after, _ = page_all(index, encode_cursor(key, last_skip))
+    late = [event(n, "07:10:00")["@id"] for n in [100, 102]]
+    assert all(seen_after.count(i) == 1 for i in late)
+    assert len(set(seen_after) & set(e["@id"] for e in graph)) == 0
+    assert event(101, "07:09:59")["@id"] not in seen_after
+    print("Late events OK")
+
+    # A cursor after the last event stays there
+    assert page_all(index, cursor)[0] == []
+finally:
+    shutil.rmtree(directory)
+
+# Anything but two non-negative numbers is rejected, the handler answers it with 400
+for garbage in ["garbage", "!!!", "", encode_cursor(1, 0)[:-2], "YS5i",
+                encode_cursor(-1, 0), encode_cursor(1, -2)]:
+    try:
+        decode_cursor(garbage)
+    except ValueError:
+        continue
+    raise AssertionError("Accepted cursor {0}".format(garbage))
+assert decode_cursor(encode_cursor(25800, 3)) == (25800, 3)
+print("Invalid cursors OK")
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import datetime
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lc-server-faker"))
+import helpers
+
+SERVER_URL = "http://localhost:8080"
+START = datetime.datetime(2019, 1, 1)
+WINDOW = datetime.timedelta(minutes=10)
+PAGES = 144
+
+
+def page_url(base, date):
+    return "{0}/sncb/connections?departureTime={1}.000Z".format(base, date.isoformat())
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # Serves a day of empty fragments, every fragment covers WINDOW and links to the next one
+    requests = []
+    failing = set()
+
+    def do_GET(self):
+        date = helpers._departure_time(self.path)
+        start = START + (date - START) // WINDOW * WINDOW
+        StandInHandler.requests.append(start)
+        if start in StandInHandler.failing:
+            self.send_response(500)
+            self.end_headers()
+            return
+        base = "http://{0}:{1}".format(*self.server.server_address)
+        body = json.dumps({
+            "@id": page_url(base, start),
+            "hydra:next": page_url(base, start + WINDOW),
+            "hydra:previous": page_url(base, start - WINDOW),
+            "@graph": []
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/ld+json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+server = StandInServer(("127.0.0.1", 0), StandInHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+source_url = "http://{0}:{1}".format(*server.server_address)
+directory = os.path.join(tempfile.mkdtemp(), "connections")
+
+
+def fetch(start):
+    return helpers.fetch_connections(SERVER_URL, directory, source_url, start.isoformat() + ".000Z",
+                                     (start + datetime.timedelta(days=1)).isoformat() + "Z", retries=0)
+
+
+def saved():
+    return sorted(f for f in os.listdir(directory) if f.endswith(".jsonld"))
+
+
+try:
+    # A failed download keeps what was saved and the state to resume from
+    StandInHandler.failing = {START + 20 * WINDOW, START + 100 * WINDOW}
+    assert not fetch(START)
+    assert os.path.exists(os.path.join(directory, helpers.FETCH_STATE))
+    assert 0 < len(saved()) < PAGES
+    print("Failed download OK")
+
+    # The next run resumes the same day, even when it starts on another day, and only downloads the missing pages
+    StandInHandler.failing = set()
+    StandInHandler.requests = []
+    before = len(saved())
+    assert fetch(START + datetime.timedelta(days=1))
+    assert len(saved()) == PAGES
+    assert all(f.startswith(START.date().isoformat()) for f in saved())
+    assert len(StandInHandler.requests) < PAGES - before + helpers.FETCH_RANGES
+    assert not os.path.exists(os.path.join(directory, helpers.FETCH_STATE))
+    print("Resumed download OK")
+
+    # The links point to the server instead of the source
+    with open(os.path.join(directory, saved()[0]), "r") as json_file:
+        fragment = json.load(json_file)
+    assert fragment["hydra:next"].startswith(SERVER_URL)
+    assert fragment["hydra:previous"].startswith(SERVER_URL)
+    print("Hydra links OK")
+
+    # A complete dataset is never downloaded again
+    StandInHandler.requests = []
+    assert fetch(START + datetime.timedelta(days=2))
+    assert len(StandInHandler.requests) == 0
+    assert len(saved()) == PAGES
+    print("Complete dataset OK")
+finally:
+    server.shutdown()
+    shutil.rmtree(os.path.dirname(directory))
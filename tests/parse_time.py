@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+import calendar
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lc-server-faker"))
+import model
+
+EXPECTED = calendar.timegm(datetime.datetime(2019, 1, 1, 7, 10, 30).utctimetuple())
+
+# The fixed format of the fragments
+assert model.parse_time("2019-01-01T07:10:30.000Z") == EXPECTED
+assert model.parse_time("2019-01-01T07:10:30Z") == EXPECTED
+assert model.parse_time("2019-01-01T07:10:30.750Z") == EXPECTED
+assert model.parse_time(model.format_time(EXPECTED)) == EXPECTED
+print("UTC timestamps OK")
+
+# Offsets are converted to UTC instead of being cut off
+assert model.parse_time("2019-01-01T08:10:30+01:00") == EXPECTED
+assert model.parse_time("2019-01-01T08:10:30.000+01:00") == EXPECTED
+assert model.parse_time("2019-01-01T05:10:30.000-02:00") == EXPECTED
+assert model.parse_time("2019-01-02T00:10:30+17:00") == EXPECTED
+print("Offset timestamps OK")
@@ -22,6 +22,11 @@ r = requests.get(PROTOCOL_HTTP + HOST + "/sncb/events?lastSyncTime=" + formatted
 r.raise_for_status()
 print("/events/poll resource OK")
 
+# Test an invalid /events cursor
+r = requests.get(PROTOCOL_HTTP + HOST + "/sncb/events?cursor=garbage")
+assert r.status_code == 400
+print("/events cursor validation OK")
+
 # Test the /events/sse resource
 r = SSEClient(PROTOCOL_HTTP + HOST + "/sncb/events/sse?lastSyncTime=" + formatted_date)
 for msg in r:
@@ -43,3 +48,26 @@ r = requests.post(PROTOCOL_HTTP + HOST + "/sncb/events/new", data=dict(timestamp
                                                                         action="cancel"))
 r.raise_for_status()
 print("/events/new resource OK")
+
+# Test the /events/bulk resource
+r = requests.post(PROTOCOL_HTTP + HOST + "/sncb/events/bulk", json=[
+    {
+        "@id": "http://irail.be/connections/test#" + formatted_date,
+        "@type": "Event",
+        "sosa:resultTime": formatted_date,
+        "sosa:hasResult": {
+            "@type": "sosa:hasResult",
+            "Connection": {
+                "@id": "http://irail.be/connections/test",
+                "@type": "CanceledConnection"
+            }
+        }
+    }
+])
+r.raise_for_status()
+print("/events/bulk resource OK")
+
+# Test the /metrics resource
+r = requests.get(PROTOCOL_HTTP + HOST + "/metrics")
+r.raise_for_status()
+print("/metrics resource OK")
@@ -22,3 +22,7 @@ sleep 1s
 
 # Run tests
 python tests/tests.py
+python tests/fetch.py
+python tests/parse_time.py
+python tests/backpressure.py
+python tests/cursor.py